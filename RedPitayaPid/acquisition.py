@@ -0,0 +1,219 @@
+"""Shared acquisition helpers for the on-board capture scripts.
+
+Buffers are allocated once and read straight into NumPy, samples stay int16 and
+are only converted to volts when asked for. Set RP_FAKE=1 to run against the
+synthetic signal of fake_rp instead of the board.
+"""
+
+import ctypes
+import os
+import time
+import numpy as np
+
+if os.environ.get("RP_FAKE"):
+    import fake_rp as rp
+else:
+    import rp
+
+ADC_BITS = 14
+ADC_RATE = 125e6
+ADC_FULL_SCALE = {rp.RP_LOW: 1.0, rp.RP_HIGH: 20.0}  # Volts at full scale for each input gain
+
+
+def swig_array(buffer, size, ctype=ctypes.c_int16):
+    # NumPy view over the memory of a SWIG i16Buffer, no copy
+    address = int(buffer.this)
+    return np.ctypeslib.as_array((ctype * size).from_address(address))
+
+
+class BufferReader:
+    # One preallocated buffer per channel and size, reused for every read
+    def __init__(self, buffer_size, channel=rp.RP_CH_1):
+        self.buffer_size = buffer_size
+        self.channel = channel
+        self.numpy_api = hasattr(rp, "rp_AcqGetDataRawNP")
+        if self.numpy_api:
+            self._swig = None
+            self.array = np.zeros(buffer_size, dtype=np.int16)
+        else:
+            self._swig = rp.i16Buffer(buffer_size)
+            self.array = swig_array(self._swig, buffer_size)
+        self._swig_volts = None  # fBuffer for read_volts, only allocated when needed
+
+    def read(self, position=0, out=None):
+        # With the NumPy API the samples land directly in `out`, otherwise in the shared buffer
+        # which is then copied in one block. Without `out` the returned view is overwritten by the next read.
+        if self.numpy_api:
+            target = self.array if out is None else out
+            rp.rp_AcqGetDataRawNP(self.channel, position, target)
+            return target
+        rp.rp_AcqGetDataRaw(self.channel, position, self.buffer_size, self._swig.cast())
+        if out is None:
+            return self.array
+        out[:] = self.array
+        return out
+
+    def read_oldest(self, out=None):
+        if self.numpy_api:
+            target = self.array if out is None else out
+            rp.rp_AcqGetOldestDataRawNP(self.channel, target)
+            return target
+        rp.rp_AcqGetOldestDataRaw(self.channel, self.buffer_size, self._swig.cast())
+        if out is None:
+            return self.array
+        out[:] = self.array
+        return out
+
+    def read_volts(self, position=0, out=None):
+        # The same buffer through rp_AcqGetDataV, which applies the board's gain and offset calibration
+        if out is None:
+            out = np.empty(self.buffer_size, dtype=np.float32)
+        if hasattr(rp, "rp_AcqGetDataVNP"):
+            rp.rp_AcqGetDataVNP(self.channel, position, out)
+            return out
+        if self._swig_volts is None:
+            self._swig_volts = rp.fBuffer(self.buffer_size)
+            self.volts_array = swig_array(self._swig_volts, self.buffer_size, ctypes.c_float)
+        rp.rp_AcqGetDataV(self.channel, position, self.buffer_size, self._swig_volts)
+        out[:] = self.volts_array
+        return out
+
+
+_readers = {}
+
+
+def get_reader(buffer_size, channel=rp.RP_CH_1):
+    key = (buffer_size, channel)
+    if key not in _readers:
+        _readers[key] = BufferReader(buffer_size, channel)
+    return _readers[key]
+
+
+class Capture:
+    # Raw int16 samples plus calibrated volts when they were read from the board (see BufferReader.read_volts).
+    # Without them volts are computed from the nominal full scale on first access, which ignores the
+    # board's calibration, so use calibrated=True captures for anything saved in volts.
+    def __init__(self, raw, gain=rp.RP_LOW, volts=None):
+        self.raw = raw
+        self.gain = gain
+        self.volts_per_count = ADC_FULL_SCALE[gain] / 2 ** (ADC_BITS - 1)
+        self.calibrated = volts is not None
+        self._volts = volts
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def volts(self):
+        if self._volts is None:
+            self._volts = self.raw.astype(np.float32) * np.float32(self.volts_per_count)
+        return self._volts
+
+
+# Decimation constant -> factor, whatever values the rp enum uses
+DECIMATION_FACTORS = {getattr(rp, f"RP_DEC_{2 ** n}"): 2 ** n for n in range(17) if hasattr(rp, f"RP_DEC_{2 ** n}")}
+
+
+class Acquirer:
+    # Keeps the acquisition engine initialized between captures. Settings are cached and a
+    # setter is only called when its value changes, and buffer fills are waited out with
+    # sleeps computed from the decimation instead of spinning on the state registers.
+    def __init__(self, buffer_size=16384, channel=rp.RP_CH_1, poll_fraction=0.05):
+        self.buffer_size = buffer_size
+        self.channel = channel
+        self.poll_fraction = poll_fraction  # Re-check interval as a fraction of the fill time
+        self.reader = get_reader(buffer_size, channel)
+        self.settings = {}
+        self.trigger_source = None  # Set again on every start, None leaves the board's trigger source alone
+        self.is_open = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def open(self):
+        if self.is_open:
+            return
+        rp.rp_Init()
+        rp.rp_AcqReset()
+        self.settings = {}
+        self.is_open = True
+
+    def close(self):
+        if self.is_open:
+            rp.rp_AcqStop()
+            rp.rp_Release()
+            self.is_open = False
+
+    def _apply(self, name, value, setter):
+        if value is not None and self.settings.get(name) != value:
+            setter(value)
+            self.settings[name] = value
+
+    def configure(self, decimation=None, trigger_level=None, trigger_delay=None, gain=None, trigger_source=None):
+        self.open()
+        self._apply("decimation", decimation, rp.rp_AcqSetDecimation)
+        self._apply("trigger_level", trigger_level, lambda level: rp.rp_AcqSetTriggerLevel(rp.RP_T_CH_1, level))
+        self._apply("trigger_delay", trigger_delay, rp.rp_AcqSetTriggerDelay)
+        self._apply("gain", gain, lambda value: rp.rp_AcqSetGain(self.channel, value))
+        if trigger_source is not None:
+            self.trigger_source = trigger_source
+
+    @property
+    def samplerate(self):
+        return ADC_RATE / DECIMATION_FACTORS[self.settings.get("decimation", rp.RP_DEC_1)]
+
+    @property
+    def fill_time(self):
+        return self.buffer_size / self.samplerate
+
+    def wait_for_buffer(self):
+        # Sleep through the time the buffer needs to fill, then confirm with a few cheap checks
+        time.sleep(self.fill_time)
+        interval = max(self.fill_time * self.poll_fraction, 1e-4)
+        while rp.rp_AcqGetTriggerState()[1] != rp.RP_TRIG_STATE_TRIGGERED:
+            time.sleep(interval)
+        while not rp.rp_AcqGetBufferFillState()[1]:
+            time.sleep(interval)
+
+    def acquire(self):
+        rp.rp_AcqStart()
+        if self.trigger_source is not None:
+            rp.rp_AcqSetTriggerSrc(self.trigger_source)
+        self.wait_for_buffer()
+
+    def iter_buffers(self, num_buffers=None):
+        # Yields one int16 buffer per acquisition, the view is reused so copy it to keep it
+        count = 0
+        while num_buffers is None or count < num_buffers:
+            self.acquire()
+            yield self.reader.read()
+            count += 1
+
+    def capture(self, num_buffers=1, calibrated=False):
+        # calibrated=True also reads every buffer in volts through rp_AcqGetDataV
+        all_data = np.empty(num_buffers * self.buffer_size, dtype=np.int16)
+        volts = np.empty(num_buffers * self.buffer_size, dtype=np.float32) if calibrated else None
+        for buffer_index in range(num_buffers):
+            self.acquire()
+            start_idx = buffer_index * self.buffer_size
+            self.reader.read(out=all_data[start_idx:start_idx + self.buffer_size])
+            if calibrated:
+                self.reader.read_volts(out=volts[start_idx:start_idx + self.buffer_size])
+        return Capture(all_data, self.settings.get("gain", rp.RP_LOW), volts)
+
+
+def capture_raw(num_buffers=1, buffer_size=16384, decimation=rp.RP_DEC_16384, trigger_level=0.5,
+                trigger_source=None, gain=rp.RP_LOW, channel=rp.RP_CH_1, calibrated=False):
+    # One-off capture, initializes and releases the engine around it. Use an Acquirer for repeated captures.
+    try:
+        with Acquirer(buffer_size, channel) as acquirer:
+            acquirer.configure(decimation=decimation, trigger_level=trigger_level, trigger_delay=0, gain=gain,
+                               trigger_source=trigger_source)
+            return acquirer.capture(num_buffers, calibrated)
+    except Exception as e:
+        print(f"Error during acquisition: {e}")
+        return None
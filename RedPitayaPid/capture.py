@@ -1,63 +1,18 @@
 import numpy as np 
-import rp
 import time
-def capture_signal(num_buffers=1, buffer_size=16384, decimation=rp.RP_DEC_16384, trigger_level=0.5):
-    try:
-        # Initialize the Red Pitaya API
-        rp.rp_Init()
+from acquisition import rp, capture_raw, get_reader, Capture
 
-        # Configure acquisition settings
-        rp.rp_AcqReset()
-        rp.rp_AcqSetDecimation(decimation)
-        rp.rp_AcqSetTriggerLevel(rp.RP_T_CH_1, trigger_level)
-        rp.rp_AcqSetTriggerDelay(0)  # Set trigger delay
-        rp.rp_AcqSetGain(rp.RP_CH_1, rp.RP_LOW)  # Set channel gain
-        rp.rp_AcqStart()  # Start acquisition
-
-        # Allocate space for all data
-        all_data = np.zeros(num_buffers * buffer_size, dtype=float)
-
-        for buffer_index in range(num_buffers):
-            # Trigger the acquisition
-            #rp.rp_AcqReset()
-            #rp.rp_AcqSetDecimation(decimation)
-            #rp.rp_AcqSetTriggerLevel(rp.RP_T_CH_1, trigger_level)
-            #rp.rp_AcqSetTriggerDelay(0)  # Set trigger delay
-            ##rp.rp_AcqSetGain(rp.RP_CH_1, rp.RP_LOW)  # Set channel gain
-            rp.rp_AcqStart()  # Start continuous acquisition
-            #rp.rp_AcqSetTriggerSrc(rp.RP_TRIG_SRC_NOW)
 
-            # Wait for the trigger
-            while True:
-                trig_state = rp.rp_AcqGetTriggerState()[1]
-                if trig_state == rp.RP_TRIG_STATE_TRIGGERED:
-                    break
+def save_capture(capture, path="acquisition_data.csv"):
+    np.savetxt(path, capture.volts, fmt="%.8g")
 
-            # Wait for the buffer to be filled
-            while True:
-                if rp.rp_AcqGetBufferFillState()[1]:
-                    break
 
-            # Read data into the corresponding part of the array
-            temp_buffer = rp.fBuffer(buffer_size)
-            rp.rp_AcqGetDataV(rp.RP_CH_1, 0, buffer_size, temp_buffer)
-
-            # Copy data into the larger array
-            start_idx = buffer_index * buffer_size
-            end_idx = start_idx + buffer_size
-            all_data[start_idx:end_idx] = [temp_buffer[i] for i in range(buffer_size)]
-        with open("acquisition_data.csv", "w") as file:
-            for val in all_data:
-                file.write(f"{val}\n")
-        return all_data
-
-    except Exception as e:
-        print(f"Error during acquisition: {e}")
+def capture_signal(num_buffers=1, buffer_size=16384, decimation=rp.RP_DEC_16384, trigger_level=0.5):
+    capture = capture_raw(num_buffers, buffer_size, decimation, trigger_level, calibrated=True)
+    if capture is None:
         return None
-
-    finally:
-        # Release the Red Pitaya resources
-        rp.rp_Release()
+    save_capture(capture)
+    return capture.volts
 
 
 def continuous_capture(num_buffers=10, buffer_size=16384, decimation=rp.RP_DEC_8192):
@@ -71,29 +26,25 @@ def continuous_capture(num_buffers=10, buffer_size=16384, decimation=rp.RP_DEC_8
         #rp.rp_AcqSetTriggerSrc(rp.RP_TRIG_SRC_DISABLED)  # No triggering
         rp.rp_AcqStart()  # Start continuous acquisition
 
-        # Allocate space for all data
-        all_data = np.zeros(num_buffers * buffer_size, dtype=float)
+        reader = get_reader(buffer_size)
+        all_data = np.empty(num_buffers * buffer_size, dtype=np.int16)
+        volts = np.empty(num_buffers * buffer_size, dtype=np.float32)
 
         for buffer_index in range(num_buffers):
             # Read data from the buffer
             print("a)")
             time.sleep(buffer_size/125e6 * 8192)
-            
-            temp_buffer = rp.fBuffer(buffer_size)
-            rp.rp_AcqGetDataV(rp.RP_CH_1, 0, buffer_size, temp_buffer)
 
-            # Copy data into the larger array
             start_idx = buffer_index * buffer_size
-            end_idx = start_idx + buffer_size
-            all_data[start_idx:end_idx] = [temp_buffer[i] for i in range(buffer_size)]
+            reader.read(out=all_data[start_idx:start_idx + buffer_size])
+            reader.read_volts(out=volts[start_idx:start_idx + buffer_size])
 
             # Optional: Add a delay to sync with the sampling rate
 
         # Save data to file
-        with open("acquisition_data.csv", "w") as file:
-            for val in all_data:
-                file.write(f"{val}\n")
-        return all_data
+        capture = Capture(all_data, volts=volts)
+        save_capture(capture)
+        return capture.volts
 
     except Exception as e:
         print(f"Error during acquisition: {e}")
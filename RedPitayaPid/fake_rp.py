@@ -0,0 +1,180 @@
+"""Offline stand-in for the Red Pitaya `rp` module.
+
+Implements the acquisition calls used in this directory against a synthetic
+interferometer signal so the capture code can run on a machine without the board.
+acquisition.py only uses it when RP_FAKE is set.
+"""
+
+import numpy as np
+
+RP_OK = 0
+
+RP_CH_1 = 0
+RP_CH_2 = 1
+RP_T_CH_1 = 0
+RP_T_CH_2 = 1
+
+RP_LOW = 0
+RP_HIGH = 1
+
+for _factor in [2 ** n for n in range(17)]:
+    globals()[f"RP_DEC_{_factor}"] = _factor
+
+RP_TRIG_SRC_DISABLED = 0
+RP_TRIG_SRC_NOW = 1
+RP_TRIG_SRC_CHA_PE = 2
+RP_TRIG_SRC_CHA_NE = 3
+
+RP_TRIG_STATE_TRIGGERED = 0
+RP_TRIG_STATE_WAITING = 1
+
+ADC_BUFFER_SIZE = 16384
+ADC_RATE = 125e6
+
+_state = {
+    "decimation": RP_DEC_1,
+    "trigger_level": 0.0,
+    "trigger_delay": 0,
+    "trigger_source": RP_TRIG_SRC_DISABLED,
+    "gain": {RP_CH_1: RP_LOW, RP_CH_2: RP_LOW},
+    "running": False,
+    "samples_taken": 0,
+}
+_rng = np.random.default_rng(0)
+calls = []  # (name, args) of every configuration call, handy for checking what a caller did
+
+
+def _record(name, *args):
+    calls.append((name, args))
+    return RP_OK
+
+
+def _signal(n):
+    # Slowly drifting interference fringe plus white noise, in raw 14 bit counts
+    start = _state["samples_taken"]
+    t = (start + np.arange(n)) * _state["decimation"] / ADC_RATE
+    _state["samples_taken"] += n
+    phase = 2 * np.pi * 0.5 * t + 0.3 * np.sin(2 * np.pi * 7 * t)
+    raw = 6000 * np.sin(phase) + _rng.normal(0, 40, n)
+    return np.clip(raw, -8192, 8191).astype(np.int16)
+
+
+class _Buffer:
+    def __init__(self, size, dtype):
+        self.array = np.zeros(size, dtype=dtype)
+        self.this = self.array.ctypes.data  # Address of the samples, like SWIG's pointer object
+
+    def __getitem__(self, i):
+        return self.array[i].item()
+
+    def __setitem__(self, i, value):
+        self.array[i] = value
+
+    def __len__(self):
+        return len(self.array)
+
+    def cast(self):
+        return self
+
+
+class i16Buffer(_Buffer):
+    def __init__(self, size):
+        super().__init__(size, np.int16)
+
+
+class fBuffer(_Buffer):
+    def __init__(self, size):
+        super().__init__(size, np.float32)
+
+
+def _volts(raw, channel):
+    full_scale = 1.0 if _state["gain"][channel] == RP_LOW else 20.0
+    return raw.astype(np.float32) * (full_scale / 8192)
+
+
+def rp_Init():
+    return _record("rp_Init")
+
+
+def rp_Release():
+    return _record("rp_Release")
+
+
+def rp_AcqReset():
+    _state["running"] = False
+    return _record("rp_AcqReset")
+
+
+def rp_AcqSetDecimation(decimation):
+    _state["decimation"] = decimation
+    return _record("rp_AcqSetDecimation", decimation)
+
+
+def rp_AcqGetDecimation():
+    return [RP_OK, _state["decimation"]]
+
+
+def rp_AcqSetTriggerLevel(channel, level):
+    _state["trigger_level"] = level
+    return _record("rp_AcqSetTriggerLevel", channel, level)
+
+
+def rp_AcqSetTriggerDelay(delay):
+    _state["trigger_delay"] = delay
+    return _record("rp_AcqSetTriggerDelay", delay)
+
+
+def rp_AcqSetTriggerSrc(source):
+    _state["trigger_source"] = source
+    return _record("rp_AcqSetTriggerSrc", source)
+
+
+def rp_AcqSetGain(channel, gain):
+    _state["gain"][channel] = gain
+    return _record("rp_AcqSetGain", channel, gain)
+
+
+def rp_AcqStart():
+    _state["running"] = True
+    return _record("rp_AcqStart")
+
+
+def rp_AcqStop():
+    _state["running"] = False
+    return _record("rp_AcqStop")
+
+
+def rp_AcqGetTriggerState():
+    return [RP_OK, RP_TRIG_STATE_TRIGGERED]
+
+
+def rp_AcqGetBufferFillState():
+    return [RP_OK, True]
+
+
+def rp_AcqGetDataRawNP(channel, position, np_buffer):
+    np_buffer[:] = _signal(len(np_buffer))
+    return RP_OK
+
+
+def rp_AcqGetOldestDataRawNP(channel, np_buffer):
+    return rp_AcqGetDataRawNP(channel, 0, np_buffer)
+
+
+def rp_AcqGetDataVNP(channel, position, np_buffer):
+    np_buffer[:] = _volts(_signal(len(np_buffer)), channel)
+    return RP_OK
+
+
+def rp_AcqGetDataRaw(channel, position, size, buffer):
+    buffer.array[:size] = _signal(size)
+    return RP_OK
+
+
+def rp_AcqGetOldestDataRaw(channel, size, buffer):
+    return rp_AcqGetDataRaw(channel, 0, size, buffer)
+
+
+def rp_AcqGetDataV(channel, position, size, buffer):
+    buffer.array[:size] = _volts(_signal(size), channel)
+    return RP_OK
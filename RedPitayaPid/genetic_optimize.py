@@ -1,22 +1,72 @@
 import numpy as np
 import os
+import sys
 import matplotlib.pyplot as plt
-import rp
+from acquisition import rp, Acquirer, ADC_BITS, ADC_FULL_SCALE
 # Define the PID parameter range
 PID_RANGE = (-2**13, 2**13)
-
-
-def evaluate_policy(pid_vals, csv_path="/root/acquisition_data.csv"):
+ITERATIONS = 20  # Captures per candidate, the most a settling-aware evaluation will take
+SETTLING_CAPTURE = False  # Skip the transient after the gain change and stop once the reward is pinned down
+# Reward for a capture, a fitness.PRESETS name or a {metric: weight} dict, scored on the raw int16 samples.
+# "std" is the original -np.std(volts), "band_noise" integrates the noise over FITNESS_BAND (Hz).
+FITNESS = "std"
+FITNESS_BAND = (10, 1000)
+# "genetic" or "surrogate" (Gaussian-process model with expected improvement, far fewer evaluations)
+OPTIMIZER = "genetic"
+SURROGATE_EVALUATIONS = 45
+
+
+def use_shared_modules():
+    # settling, fitness and surrogate_optimize live in the repo root. The path is only extended, and
+    # they are only imported, when a setting needs them, so plain runs on the board load nothing extra.
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.append(root)
+
+
+# Initialized once and reused for every capture of the run
+acquirer = Acquirer(buffer_size=16384)
+GAIN = rp.RP_LOW
+fitness = None  # Built on first use
+
+
+def capture_reward(raw):
+    # Scored in ADC counts and scaled to volts, so captures never get converted to float arrays
+    global fitness
+    if fitness is None:
+        use_shared_modules()
+        from fitness import make_fitness
+        fitness = make_fitness(FITNESS, band=FITNESS_BAND, scale=ADC_FULL_SCALE[GAIN] / 2 ** (ADC_BITS - 1))
+    return fitness(raw, acquirer.samplerate)
+
+
+def capture_stream():
+    while True:
+        signal = capture_signal()
+        if signal is None:
+            raise RuntimeError("Capture failed")
+        yield signal.raw
+
+
+def evaluate_policy(pid_vals, csv_path="/root/acquisition_data.csv", reject_below=None):
     try:
         # Step 1: Run the PID executable with the PID parameters
         pid_command = f"/root/pid {int(pid_vals[0])} {int(pid_vals[1])} {int(pid_vals[2])}"
         os.system(pid_command)  # Execute the PID control command
-        iterations = 20 
-        reward = [0 for i in range(iterations)]
-        for i in range(iterations):
-            signal = capture_signal()
-            reward[i] = -np.std(signal)
-        reward = np.mean(reward)
+        if SETTLING_CAPTURE:
+            use_shared_modules()
+            from settling import settled_capture
+            result = settled_capture(capture_stream(), capture_reward, min_chunks=3,
+                                     max_samples=ITERATIONS * 10 * acquirer.buffer_size,
+                                     reject_below=reject_below, keep_data=False)
+            print(f"    {result}")
+            reward = result.fitness
+        else:
+            reward = [0 for i in range(ITERATIONS)]
+            for i in range(ITERATIONS):
+                signal = capture_signal()
+                reward[i] = capture_reward(signal.raw)
+            reward = np.mean(reward)
         with open("genetic_log.txt", "a") as file:
             print(f"    {pid_command}, reward = {reward}")
             file.write(f" {pid_command}, reward = {reward}\n")
@@ -28,57 +78,15 @@ def evaluate_policy(pid_vals, csv_path="/root/acquisition_data.csv"):
 
 
 
-def capture_signal(num_buffers=10, buffer_size=16384, decimation=rp.RP_DEC_2, trigger_level=0.5):
+def capture_signal(num_buffers=10, decimation=rp.RP_DEC_2, trigger_level=0.5):
     try:
-        # Initialize the Red Pitaya API
-        rp.rp_Init()
-
-        # Configure acquisition settings
-        rp.rp_AcqReset()
-        rp.rp_AcqSetDecimation(decimation)
-        rp.rp_AcqSetTriggerLevel(rp.RP_T_CH_1, trigger_level)
-        rp.rp_AcqSetTriggerDelay(0)  # Set trigger delay
-        rp.rp_AcqSetGain(rp.RP_CH_1, rp.RP_LOW)  # Set channel gain
-        rp.rp_AcqStart()  # Start acquisition
-
-        # Allocate space for all data
-        all_data = np.zeros(num_buffers * buffer_size, dtype=float)
-
-        for buffer_index in range(num_buffers):
-            # Trigger the acquisition
-            rp.rp_AcqStart()  # Start continuous acquisition
-            rp.rp_AcqSetTriggerSrc(rp.RP_TRIG_SRC_NOW)
-
-            # Wait for the trigger
-            while True:
-                trig_state = rp.rp_AcqGetTriggerState()[1]
-                if trig_state == rp.RP_TRIG_STATE_TRIGGERED:
-                    break
-
-            # Wait for the buffer to be filled
-            while True:
-                if rp.rp_AcqGetBufferFillState()[1]:
-                    break
-
-            # Read data into the corresponding part of the array
-            temp_buffer = rp.fBuffer(buffer_size)
-            rp.rp_AcqGetDataV(rp.RP_CH_1, 0, buffer_size, temp_buffer)
-
-            # Copy data into the larger array
-            start_idx = buffer_index * buffer_size
-            end_idx = start_idx + buffer_size
-            all_data[start_idx:end_idx] = [temp_buffer[i] for i in range(buffer_size)]
-
-        return all_data
-
+        acquirer.configure(decimation=decimation, trigger_level=trigger_level, trigger_delay=0, gain=GAIN,
+                           trigger_source=rp.RP_TRIG_SRC_NOW)
+        return acquirer.capture(num_buffers)
     except Exception as e:
         print(f"Error during acquisition: {e}")
         return None
 
-    finally:
-        # Release the Red Pitaya resources
-        rp.rp_Release()
-
 
 def initialize_population(pop_size, pid_range):
     # Sample from three normal distributions
@@ -105,10 +113,12 @@ def genetic_algorithm(pop_size=4, generations=10, mutation_rate=50):
     population = initialize_population(pop_size, PID_RANGE)
     best_rewards = []
     best_params = None
+    reject_below = None
 
     for generation in range(generations):
-        # Evaluate the population
-        rewards = np.array([evaluate_policy(pid) for pid in population])
+        # Evaluate the population, candidates clearly below last generation's median are cut short
+        rewards = np.array([evaluate_policy(pid, reject_below=reject_below) for pid in population])
+        reject_below = np.median(rewards[np.isfinite(rewards)]) if np.isfinite(rewards).any() else None
         sorted_indices = np.argsort(rewards)[::-1]  # Sort by reward (descending)
         population = population[sorted_indices]    # Sort population by fitness
         rewards = rewards[sorted_indices]
@@ -141,12 +151,39 @@ def genetic_algorithm(pop_size=4, generations=10, mutation_rate=50):
     return best_params, best_rewards
 
 
+def surrogate_optimization(evaluations=SURROGATE_EVALUATIONS):
+    # One candidate at a time, each proposal uses every reward measured so far
+    use_shared_modules()
+    from surrogate_optimize import SurrogateOptimizer
+    surrogate = SurrogateOptimizer([PID_RANGE] * 3, integer=True)
+    best_rewards = []
+
+    def evaluate(candidates):
+        # Candidates clearly below the median so far are cut short, as between GA generations
+        finite = [reward for reward in surrogate.y if np.isfinite(reward)]
+        reject_below = np.median(finite) if len(finite) >= surrogate.n_initial else None
+        return [evaluate_policy(pid, reject_below=reject_below) for pid in candidates]
+
+    def log_progress(index, candidates, rewards):
+        best_rewards.append(surrogate.best[1])
+        with open("genetic_log.txt", "a") as file:
+            print(f"Evaluation {index + 1}: Best Reward = {best_rewards[-1]}")
+            file.write(f"Evaluation {index + 1}: Best Reward = {best_rewards[-1]}\n")
+
+    best_params, _ = surrogate.run(evaluate, evaluations, on_batch=log_progress)
+    return best_params, best_rewards
+
+
 def main():
     # Run the genetic algorithm
     print("Running Optimization")
     with open("genetic_log.txt", "w") as file:
         pass
-    best_params, best_rewards = genetic_algorithm(pop_size=15, generations=15, mutation_rate=500)
+    with acquirer:
+        if OPTIMIZER == "surrogate":
+            best_params, best_rewards = surrogate_optimization()
+        else:
+            best_params, best_rewards = genetic_algorithm(pop_size=15, generations=15, mutation_rate=500)
 
     with open("genetic_log.txt", "a") as file:
         print(f"Optimal PID Parameters: {best_params}")
@@ -155,8 +192,8 @@ def main():
 
     # Plot the best reward over generations
     plt.plot(best_rewards, label="Best Reward")
-    plt.title("Genetic Algorithm Optimization")
-    plt.xlabel("Generation")
+    plt.title("Genetic Algorithm Optimization" if OPTIMIZER == "genetic" else "Surrogate Optimization")
+    plt.xlabel("Generation" if OPTIMIZER == "genetic" else "Evaluation")
     plt.ylabel("Reward")
     plt.legend()
     plt.grid(True)
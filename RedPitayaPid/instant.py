@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 import time
 import numpy as np
-import rp
+from acquisition import rp, get_reader, Capture
 
 
 #? Possible decimations:
@@ -58,20 +58,11 @@ while 1:
 
 
 ### Get data ###
-# RAW
-ibuff = rp.i16Buffer(N)
-res = rp.rp_AcqGetOldestDataRaw(rp.RP_CH_1, N, ibuff.cast())
-
-# Volts
-fbuff = rp.fBuffer(N)
-res = rp.rp_AcqGetDataV(rp.RP_CH_1, 0, N, fbuff)
-
-data_V = np.zeros(N, dtype = float)
-data_raw = np.zeros(N, dtype = int)
-
-for i in range(0, N, 1):
-    data_V[i] = fbuff[i]
-    data_raw[i] = ibuff[i]
+# RAW, volts calibrated by the board
+reader = get_reader(N)
+capture = Capture(reader.read_oldest().copy(), volts=reader.read_volts())
+data_raw = capture.raw
+data_V = capture.volts
 
 print(f"Data in Volts: {data_V}")
 print(f"Raw data: {data_raw}")
@@ -1,26 +1,206 @@
+import argparse
 import asyncio
-import subprocess
+import json
+import mmap
+import os
 import websockets
 
-async def shell_command_handler(websocket):
-    async for message in websocket:
-        # Execute the command using subprocess
-        process = subprocess.Popen(
-            message,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        stdout, stderr = process.communicate()
+# Base address of the PID block, mapped once when the server starts
+PID_BASE_ADDR = 0x40300000
+PID_MAP_SIZE = 4096
 
-        output = stdout.decode() + stderr.decode()
+# Integrator reset control, one bit per PID
+PID_RESET_OFFSET = 0x00
+PID_RESET_BITS = {11: 0x1, 12: 0x2, 21: 0x4, 22: 0x8}
 
-        await websocket.send(output)
+# Register offsets per PID, same layout as pid.c
+PID_OFFSETS = {
+    11: {"setpoint": 0x10, "kp": 0x14, "ki": 0x18, "kd": 0x1C},
+    12: {"setpoint": 0x20, "kp": 0x24, "ki": 0x28, "kd": 0x2C},
+    21: {"setpoint": 0x30, "kp": 0x34, "ki": 0x38, "kd": 0x3C},
+    22: {"setpoint": 0x40, "kp": 0x44, "ki": 0x48, "kd": 0x4C},
+}
+PID_PARAMETERS = ("setpoint", "kp", "ki", "kd")
+PID_VALUE_LIMIT = 8196
+PID_REGISTER_BITS = 14
 
-async def main():
-    async with websockets.serve(shell_command_handler, "0.0.0.0", 8765):
-        print("WebSocket server listening on ws://0.0.0.0:8765")
-        await asyncio.Future()  # run forever
+
+class RequestError(Exception):
+    pass
+
+
+class MemoryRegisters:
+    # Register backend over any writable buffer, accessed as 32-bit words
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._words = memoryview(buffer).cast("I")
+
+    def write(self, offset, value):
+        self._words[offset // 4] = value & 0xFFFFFFFF
+
+    def read(self, offset):
+        return self._words[offset // 4]
+
+    def close(self):
+        self._words.release()
+
+
+class DevMemRegisters(MemoryRegisters):
+    # The real PID block through /dev/mem
+    def __init__(self, base_addr=PID_BASE_ADDR, size=PID_MAP_SIZE):
+        self._fd = os.open("/dev/mem", os.O_RDWR | os.O_SYNC)
+        try:
+            self._map = mmap.mmap(self._fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE,
+                                  offset=base_addr)
+        except OSError:
+            os.close(self._fd)
+            raise
+        super().__init__(self._map)
+
+    def close(self):
+        super().close()
+        self._map.close()
+        os.close(self._fd)
+
+
+class FakeRegisters(MemoryRegisters):
+    # In-memory stand-in for running the server on a dev box
+    def __init__(self, size=PID_MAP_SIZE):
+        super().__init__(bytearray(size))
+
+
+def to_signed(value, bits=PID_REGISTER_BITS):
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value & (1 << (bits - 1)) else value
+
+
+class PidController:
+    def __init__(self, registers):
+        self.registers = registers
+
+    @staticmethod
+    def parse_channel(channel):
+        try:
+            channel = int(channel)
+        except (TypeError, ValueError):
+            raise RequestError(f"Invalid channel {channel!r}")
+        if channel not in PID_OFFSETS:
+            raise RequestError(f"Invalid channel {channel}. Choose from 11, 12, 21, or 22.")
+        return channel
+
+    @staticmethod
+    def parse_value(name, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise RequestError(f"{name} must be a number, got {value!r}")
+        try:
+            value = int(value)
+        except (ValueError, OverflowError):
+            raise RequestError(f"{name} must be finite, got {value!r}")
+        if not -PID_VALUE_LIMIT <= value <= PID_VALUE_LIMIT:
+            raise RequestError(f"{name} must be in the range -{PID_VALUE_LIMIT} to {PID_VALUE_LIMIT}")
+        return value
+
+    def set_pid(self, channel, kp, ki, kd, setpoint):
+        self.set_pids({channel: {"setpoint": setpoint, "kp": kp, "ki": ki, "kd": kd}})
+
+    def set_pids(self, pids):
+        # All listed PIDs are held in reset together while their parameters are written, then released
+        # with a single write so cascaded loops start on the new gains at the same instant
+        reset_bits = 0
+        for channel in pids:
+            reset_bits |= PID_RESET_BITS[channel]
+        reset_state = self.registers.read(PID_RESET_OFFSET)
+        self.registers.write(PID_RESET_OFFSET, reset_state | reset_bits)
+        for channel, values in pids.items():
+            offsets = PID_OFFSETS[channel]
+            for name in PID_PARAMETERS:
+                self.registers.write(offsets[name], values[name])
+        self.registers.write(PID_RESET_OFFSET, reset_state & ~reset_bits)
+
+    def clear_pid(self):
+        self.set_pids({channel: dict.fromkeys(PID_PARAMETERS, 0) for channel in PID_OFFSETS})
+
+    def read_pid(self, channel):
+        offsets = PID_OFFSETS[channel]
+        return {name: to_signed(self.registers.read(offsets[name])) for name in PID_PARAMETERS}
+
+    # Requests are validated in full before any register is touched
+    def prepare(self, request):
+        if not isinstance(request, dict):
+            raise RequestError("Request must be a JSON object")
+        op = request.get("op")
+        if op == "set_pid":
+            channel = self.parse_channel(request.get("channel"))
+            values = {name: self.parse_value(name, request.get(name)) for name in PID_PARAMETERS}
+            return lambda: self.set_pid(channel, **values)
+        if op == "set_pids":
+            pids = request.get("pids")
+            if not isinstance(pids, dict) or not pids:
+                raise RequestError("set_pids needs an object of channel -> parameters")
+            parsed = {}
+            for channel, values in pids.items():
+                channel = self.parse_channel(channel)
+                if not isinstance(values, dict):
+                    raise RequestError(f"Parameters for PID{channel} must be an object")
+                parsed[channel] = {name: self.parse_value(name, values.get(name)) for name in PID_PARAMETERS}
+            return lambda: self.set_pids(parsed)
+        if op == "clear_pid":
+            return self.clear_pid
+        if op == "read_pid":
+            channel = self.parse_channel(request.get("channel"))
+            return lambda: self.read_pid(channel)
+        if op == "batch":
+            requests = request.get("requests")
+            if not isinstance(requests, list):
+                raise RequestError("batch needs a list of requests")
+            if any(isinstance(sub, dict) and sub.get("op") == "batch" for sub in requests):
+                raise RequestError("batch requests cannot be nested")
+            actions = [self.prepare(sub) for sub in requests]
+            return lambda: [action() for action in actions]
+        raise RequestError(f"Unknown op {op!r}")
+
+    def handle(self, request):
+        return self.prepare(request)()
+
+
+def handle_message(controller, message):
+    request_id = None
+    try:
+        request = json.loads(message)
+        if isinstance(request, dict):
+            request_id = request.get("id")
+        result = controller.handle(request)
+        return {"id": request_id, "ok": True, "result": result}
+    except json.JSONDecodeError:
+        return {"id": None, "ok": False, "error": "Messages must be JSON requests"}
+    except RequestError as e:
+        return {"id": request_id, "ok": False, "error": str(e)}
+    except Exception as e:
+        return {"id": request_id, "ok": False, "error": f"Register access failed: {e}"}
+
+
+def make_handler(controller):
+    async def pid_request_handler(websocket):
+        async for message in websocket:
+            await websocket.send(json.dumps(handle_message(controller, message)))
+    return pid_request_handler
+
+
+async def main(host="0.0.0.0", port=8765, fake=False):
+    registers = FakeRegisters() if fake else DevMemRegisters()
+    controller = PidController(registers)
+    try:
+        async with websockets.serve(make_handler(controller), host, port):
+            backend = "in-memory fake registers" if fake else f"/dev/mem at 0x{PID_BASE_ADDR:X}"
+            print(f"WebSocket server listening on ws://{host}:{port} ({backend})")
+            await asyncio.Future()  # run forever
+    finally:
+        registers.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="PID register server for the Red Pitaya")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fake", action="store_true", help="Use in-memory registers instead of /dev/mem")
+    args = parser.parse_args()
+    asyncio.run(main(args.host, args.port, args.fake))
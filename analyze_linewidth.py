@@ -1,21 +1,32 @@
 import soundfile as sf
 import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
-from scipy.signal import find_peaks # Import find_peaks
-import json
 from lmfit.models import BreitWignerModel, LinearModel
+from capture_store import CaptureStore
+from fit_cache import FitCache
 
 
 class SweepSegment:
-    def __init__(self, cavity_segment, ramp_segment, frequency_segment, time_segment):
+    # Holds views into the analyzer's arrays, not copies, so hundreds of segments cost next to nothing
+    __slots__ = ("ramp", "cavity", "frequency", "time", "start", "stop", "mean_time", "reversed", "quality_factor",
+                 "result", "center", "fit_report", "best_values", "rsquared")
+
+    def __init__(self, cavity_segment, ramp_segment, frequency_segment, time_segment, start=0, stop=None):
         self.ramp = ramp_segment
         self.cavity = cavity_segment
         self.frequency = frequency_segment
         self.time = time_segment
+        self.start = start  # Offsets into the parent capture, stop is inclusive
+        self.stop = start + len(cavity_segment) - 1 if stop is None else stop
         self.mean_time = np.mean(time_segment)
         self.reversed = False
         self.quality_factor = 0
         self.result = None
+        self.fit_report = None
+        self.best_values = None
+        self.rsquared = None
         self.center = self.frequency[np.argmin(self.cavity)]
         if self.ramp[0] > self.ramp[-1]:
             self.frequency = self.frequency[::-1]
@@ -23,16 +34,15 @@ class SweepSegment:
             self.reversed = True
 
     def fit_fano(self, plot=False):
-        model = BreitWignerModel() + LinearModel()
+        model = fano_model()
         #self.cavity = self.cavity[250:]
         #self.frequency = self.frequency[250:]
         x_arr = self.frequency - self.frequency[0]
-        self.result = model.fit(self.cavity, x=x_arr,
-                            center=x_arr[np.argmin(self.cavity)],
-                            amplitude=np.max(self.cavity) - np.min(self.cavity), q=0.05, sigma=1, intercept=3, slope=.01)
+        self.result = model.fit(self.cavity, x=x_arr, **initial_guess(x_arr, self.cavity))
 
         self.fit_report = self.result.fit_report()
         self.best_values = self.result.best_values
+        self.rsquared = self.result.rsquared
         if plot:
             print(self.fit_report)
             #plt.plot(self.frequency, self.cavity, label='Cavity', color='cornflowerblue')
@@ -45,23 +55,350 @@ class SweepSegment:
             plt.tight_layout()
             plt.show()
 
-    def calculate_quality_factor(self):
-        self.quality_factor = self.frequency[np.argmin(self.cavity)]/self.best_values["sigma"]
+    def calculate_quality_factor(self, sigma=None):
+        if sigma is None:
+            sigma = self.best_values["sigma"]
+        self.quality_factor = self.frequency[np.argmin(self.cavity)]/sigma
         #self.quality_factor = self.best_values["center"]/self.best_values["q"]
 
 
+SEGMENT_DTYPE = np.dtype([("start", np.int64), ("stop", np.int64), ("mean_time", np.float64), ("center", np.float64),
+                          ("reversed", np.bool_)])
+FIT_PARAMETERS = ("amplitude", "center", "sigma", "q", "intercept", "slope")
+FIT_DTYPE = np.dtype([("segment", np.int64), ("fitted", np.bool_), ("success", np.bool_), ("rsquared", np.float64)]
+                     + [(name, np.float64) for name in FIT_PARAMETERS])
+
+_fano_model = None
+
+
+def fano_model():
+    # Built once per process and reused for every fit
+    global _fano_model
+    if _fano_model is None:
+        _fano_model = BreitWignerModel() + LinearModel()
+    return _fano_model
+
+
+def open_fit_cache(path="ResonanceCaptures/fit_cache.sqlite", max_entries=200000):
+    return FitCache(FIT_DTYPE, path, max_entries=max_entries, signature=repr(fano_model()))
+
+
+def initial_guess(x_arr, cavity):
+    cavity = np.asarray(cavity)
+    return dict(center=x_arr[np.argmin(cavity)], amplitude=np.max(cavity) - np.min(cavity), q=0.05, sigma=1,
+                intercept=3, slope=.01)
+
+
+def fit_fano_run(task):
+    # Fits a run of consecutive segments in order, each one starting from the previous segment's
+    # best values. Runs in the worker processes of FanoFitEngine.
+    segment_indices, x_arrays, cavities, warm_start, min_warm_rsquared = task
+    model = fano_model()
+    params = model.make_params()
+    results = np.zeros(len(segment_indices), dtype=FIT_DTYPE)
+    previous = None
+    for row, (segment_idx, x_arr, cavity) in enumerate(zip(segment_indices, x_arrays, cavities)):
+        guess = initial_guess(x_arr, cavity)
+        if warm_start and previous is not None:
+            guess.update(previous)
+        for name, value in guess.items():
+            params[name].set(value=value)
+        result = model.fit(cavity, params, x=x_arr)
+        rsquared = result.rsquared
+        if warm_start and previous is not None and not rsquared >= min_warm_rsquared:
+            # A bad warm start (e.g. after a mode hop) gets a second try from the data-driven guess
+            for name, value in initial_guess(x_arr, cavity).items():
+                params[name].set(value=value)
+            cold = model.fit(cavity, params, x=x_arr)
+            if cold.rsquared > rsquared:
+                result, rsquared = cold, cold.rsquared
+        results[row]["segment"] = segment_idx
+        results[row]["fitted"] = True
+        results[row]["success"] = result.success
+        results[row]["rsquared"] = rsquared
+        for name in FIT_PARAMETERS:
+            results[row][name] = result.best_values[name]
+        previous = dict(result.best_values) if rsquared >= min_warm_rsquared else None
+    return results
+
+
+def breit_wigner_linear(params, x):
+    # Same function as BreitWignerModel() + LinearModel(), params columns in FIT_PARAMETERS order
+    amplitude, center, sigma, q, intercept, slope = (params[:, i:i + 1] for i in range(6))
+    half_width = sigma / 2
+    detuning = x - center
+    numerator = (q * half_width + detuning) ** 2
+    denominator = half_width ** 2 + detuning ** 2
+    return amplitude * numerator / denominator + slope * x + intercept
+
+
+def breit_wigner_linear_jacobian(params, x):
+    # Analytic derivatives of breit_wigner_linear with respect to each parameter, shape (batch, 6, samples)
+    # so the normal equations are plain batched matmuls
+    amplitude, center, sigma, q, intercept, slope = (params[:, i:i + 1] for i in range(6))
+    half_width = sigma / 2
+    detuning = x - center
+    shifted = q * half_width + detuning
+    inverse = 1 / (half_width ** 2 + detuning ** 2)
+    ratio = shifted ** 2 * inverse
+    jacobian = np.empty((len(params), 6, x.shape[-1]))
+    jacobian[:, 0] = ratio
+    jacobian[:, 1] = -2 * amplitude * (shifted - ratio * detuning) * inverse
+    jacobian[:, 2] = amplitude * (q * shifted - ratio * half_width) * inverse
+    jacobian[:, 3] = 2 * amplitude * half_width * shifted * inverse
+    jacobian[:, 4] = 1.0
+    jacobian[:, 5] = x
+    return jacobian
+
+
+def batched_levenberg_marquardt(x, y, initial, max_iterations=200, tolerance=1e-10, block_size=64):
+    # Levenberg-Marquardt on a stack of equal-length problems at once. Rows stop iterating as soon
+    # as their cost stops improving, so a few slow rows do not hold up the vectorized work. Only the
+    # normal equations JᵀJ and Jᵀr are kept per row and they are only recomputed for rows whose step
+    # was accepted, a rejected step just retries the same system with more damping.
+    params = np.array(initial, dtype=np.float64)
+    damping = np.full(len(params), 1e-3)
+    converged = np.zeros(len(params), dtype=bool)
+    residual = breit_wigner_linear(params, x) - y
+    cost = np.einsum("bn,bn->b", residual, residual)
+    jtj = np.empty((len(params), 6, 6))
+    gradient = np.empty((len(params), 6))
+
+    def linearize(rows):
+        # block_size rows at a time, so the (rows, 6, samples) Jacobian stays small
+        for block in range(0, len(rows), block_size):
+            block_rows = rows[block:block + block_size]
+            jacobian = breit_wigner_linear_jacobian(params[block_rows], x[block_rows])
+            jtj[block_rows] = jacobian @ jacobian.transpose(0, 2, 1)
+            gradient[block_rows] = (jacobian @ residual[block_rows][:, :, None])[:, :, 0]
+
+    active = np.arange(len(params))
+    linearize(active)
+    for _ in range(max_iterations):
+        if len(active) == 0:
+            break
+        JTJ = jtj[active]
+        diagonal = np.einsum("bii->bi", JTJ)
+        scaled = JTJ + (damping[active][:, None] * np.maximum(diagonal, 1e-12))[:, :, None] * np.eye(6)
+        try:
+            step = -np.linalg.solve(scaled, gradient[active][..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            break
+        trial = params[active] + step
+        trial_residual = breit_wigner_linear(trial, x[active]) - y[active]
+        trial_cost = np.einsum("bn,bn->b", trial_residual, trial_residual)
+        improved = np.isfinite(trial_cost) & (trial_cost < cost[active])
+
+        accepted = active[improved]
+        relative_change = (cost[accepted] - trial_cost[improved]) / np.maximum(cost[accepted], 1e-300)
+        params[accepted] = trial[improved]
+        residual[accepted] = trial_residual[improved]
+        cost[accepted] = trial_cost[improved]
+        damping[accepted] /= 10
+        damping[active[~improved]] *= 10
+
+        converged[accepted[relative_change < tolerance]] = True
+        step_size = np.linalg.norm(step, axis=1) / (np.linalg.norm(params[active], axis=1) + 1e-12)
+        converged[active[improved & (step_size < 1e-9)]] = True
+        stuck = damping[active] > 1e12  # No downhill step left, only converged if the gradient is tiny
+        converged[active[stuck & (np.linalg.norm(gradient[active], axis=1) < 1e-8 * np.maximum(cost[active], 1))]] = True
+        active = active[~converged[active] & ~stuck]
+        linearize(np.intersect1d(accepted, active, assume_unique=True))
+    # The model is unchanged under (sigma, q) -> (-sigma, -q), report sigma as a positive width like lmfit
+    flip = params[:, 2] < 0
+    params[flip, 2] *= -1
+    params[flip, 3] *= -1
+    return params, converged, cost
+
+
+def fit_fano_batched(segment_indices, x_arrays, cavities, max_iterations=200):
+    # Fast path for equal-length segments, returns FIT_DTYPE rows and a mask of rows that converged
+    x = np.asarray(x_arrays, dtype=np.float64)
+    y = np.asarray(cavities, dtype=np.float64)
+    initial = np.empty((len(y), 6))
+    initial[:, 0] = y.max(axis=1) - y.min(axis=1)  # amplitude
+    initial[:, 1] = x[np.arange(len(x)), np.argmin(y, axis=1)]  # center
+    initial[:, 2] = 1  # sigma
+    initial[:, 3] = 0.05  # q
+    initial[:, 4] = y.min(axis=1)  # intercept, the dip floor when q is small
+    initial[:, 5] = 0  # slope
+    params, converged, cost = batched_levenberg_marquardt(x, y, initial, max_iterations=max_iterations)
+    total = np.sum((y - y.mean(axis=1, keepdims=True)) ** 2, axis=1)
+    results = np.zeros(len(y), dtype=FIT_DTYPE)
+    results["segment"] = segment_indices
+    results["fitted"] = True
+    results["success"] = converged
+    results["rsquared"] = 1 - cost / total
+    for i, name in enumerate(FIT_PARAMETERS):
+        results[name] = params[:, i]
+    converged &= np.all(np.isfinite(params), axis=1)
+    return results, converged
+
+
+def moving_average(x, window_size):
+    # Same values as np.convolve(x, ones(w) / w, mode='valid'), in O(n) whatever the window
+    cumulative = np.concatenate([[0.0], np.cumsum(x, dtype=np.float64)])
+    return (cumulative[window_size:] - cumulative[:-window_size]) / window_size
+
+
+class SweepDetector:
+    # Finds the turning points of the sweep ramp with a Schmitt trigger: the ramp is "high" once it
+    # rises above the upper level and "low" once it falls below the lower one, and each turning point
+    # is the extremum between two such crossings. Noise inside the hysteresis band cannot create
+    # extra turning points, so no minimum peak distance is needed. Levels, sweep period and smoothing
+    # window come from calibrate(). Works on a whole capture or block by block, state carries over.
+    def __init__(self, window_size=None, hysteresis=0.25):
+        self.window_size = window_size  # None picks a twentieth of the sweep period
+        self.hysteresis = hysteresis  # Fraction of the ramp's range kept clear at either end
+        self.levels = None
+        self.period = None  # Samples per full up and down sweep
+        self.state = 0  # 1 above the upper level, -1 below the lower one, 0 before the first crossing
+        self.extremum_index = None
+        self.extremum_value = None
+        self.samples = 0  # Smoothed samples seen by update
+        self.tail = np.zeros(0)
+
+    @property
+    def calibrated(self):
+        return self.levels is not None
+
+    def calibrate(self, ramp):
+        # Levels and period only need to be roughly right, a decimated copy of a long capture does
+        stride = max(1, len(ramp) // (1 << 18))
+        coarse = np.asarray(ramp)[::stride]
+        low, high = np.percentile(coarse, [1, 99])
+        margin = self.hysteresis * (high - low)
+        self.levels = (low + margin, high - margin)
+        edges, states = self.crossings(coarse, 0)
+        edges, states = edges[1:] * stride, states[1:]  # The first crossing only leaves the unknown state
+        rising = edges[states > 0]
+        if len(rising) > 1:
+            self.period = float(np.median(np.diff(rising)))
+        elif len(edges) > 1:
+            self.period = 2 * float(np.median(np.diff(edges)))
+        if self.window_size is None:
+            self.window_size = max(1, int(self.period // 20)) if self.period else 100
+        return self.period
+
+    @property
+    def delay(self):
+        # Smoothed sample i is centered on input sample i + delay
+        return (self.window_size - 1) // 2
+
+    def align(self, smoothed, length):
+        # Smoothed ramp shifted back onto the input's sample indices, the ends it cannot cover repeat the edge values
+        if len(smoothed) == 0:
+            return np.zeros(0)
+        return np.pad(smoothed, (self.delay, length - len(smoothed) - self.delay), mode="edge")
+
+    def crossings(self, x, state):
+        # Indices where the trigger changes state and the state it changes to, starting from `state`
+        low, high = self.levels
+        above = x > high
+        outside = np.flatnonzero(above | (x < low))
+        codes = np.where(above[outside], 1, -1)
+        changed = codes != np.concatenate([[state], codes[:-1]])
+        return outside[changed], codes[changed]
+
+    def smooth(self, ramp):
+        # Moving average continued across calls, output index i averages input samples i .. i + window - 1
+        ramp = np.concatenate([self.tail, ramp])
+        if len(ramp) < self.window_size:
+            self.tail = ramp
+            return np.zeros(0)
+        self.tail = ramp[len(ramp) - self.window_size + 1:]
+        return moving_average(ramp, self.window_size)
+
+    def update(self, smoothed):
+        # Returns the turning points (indices into everything passed to update so far) confirmed by this block
+        start = self.samples
+        self.samples += len(smoothed)
+        if len(smoothed) == 0:
+            return []
+        edges, states = self.crossings(smoothed, self.state)
+        bounds = np.concatenate([[0], edges, [len(smoothed)]]).tolist()
+        turning_points = []
+        for k, (a, b) in enumerate(zip(bounds[:-1], bounds[1:])):
+            if k > 0:
+                # Crossing the opposite level confirms the extremum of the region that just ended
+                if self.extremum_index is not None:
+                    turning_points.append(self.extremum_index)
+                self.state = int(states[k - 1])
+                self.extremum_index = None
+            if b > a and self.state != 0:
+                region = smoothed[a:b]
+                i = int(np.argmax(region) if self.state > 0 else np.argmin(region))
+                if (self.extremum_index is None or (self.state > 0 and region[i] > self.extremum_value)
+                        or (self.state < 0 and region[i] < self.extremum_value)):
+                    self.extremum_index, self.extremum_value = start + a + i, region[i]
+        return turning_points
+
+    def finish(self):
+        # At the end of a capture the extremum of the open region counts unless it is the last sample
+        turning_points = []
+        if self.extremum_index is not None and self.extremum_index < self.samples - 1:
+            turning_points.append(self.extremum_index)
+        self.extremum_index = None
+        return turning_points
+
+
+def detect_turning_points(ramp, window_size=None, hysteresis=0.25):
+    # Smoothed ramp aligned with `ramp` and sorted turning point indices into both, including both ends
+    detector = SweepDetector(window_size, hysteresis)
+    detector.calibrate(ramp)
+    smoothed = detector.smooth(ramp)
+    turning_points = np.asarray(detector.update(smoothed) + detector.finish(), dtype=int) + detector.delay
+    smoothed = detector.align(smoothed, len(ramp))
+    return smoothed, np.union1d(turning_points, [0, len(smoothed) - 1]).astype(int), detector
+
+
+class FanoFitEngine:
+    # Fits segments across a process pool. Segments are split into contiguous runs so that warm
+    # starting from the neighbouring sweep still works inside every worker.
+    def __init__(self, processes=None, warm_start=True, min_warm_rsquared=0.5, runs_per_process=4):
+        self.processes = processes or os.cpu_count() or 1
+        self.warm_start = warm_start
+        self.min_warm_rsquared = min_warm_rsquared
+        self.runs_per_process = runs_per_process
+
+    def fit(self, segments, segment_indices):
+        segment_indices = list(segment_indices)
+        if not segment_indices:
+            return np.zeros(0, dtype=FIT_DTYPE)
+        n_runs = min(len(segment_indices), self.processes * self.runs_per_process)
+        tasks = []
+        for run in np.array_split(np.arange(len(segment_indices)), n_runs):
+            indices = [segment_indices[i] for i in run]
+            x_arrays = [np.asarray(segments[i].frequency) - segments[i].frequency[0] for i in indices]
+            cavities = [np.asarray(segments[i].cavity) for i in indices]
+            tasks.append((indices, x_arrays, cavities, self.warm_start, self.min_warm_rsquared))
+        if self.processes == 1 or len(tasks) == 1:
+            return np.concatenate([fit_fano_run(task) for task in tasks])
+        with ProcessPoolExecutor(max_workers=self.processes) as pool:
+            return np.concatenate(list(pool.map(fit_fano_run, tasks)))
+
+
 class ResonanceAnalyzer:
-    def __init__(self, path, sweep_width, start_freq=0.0, plot=False):
+    def __init__(self, path, sweep_width, start_freq=0.0, plot=False, data=None, samplerate=None, scale=1.0):
         self.sweep_width = sweep_width
         self.start_freq = start_freq
         self.path = path
-        self.data, self.samplerate = sf.read(self.path)
+        if data is None:
+            self.data, self.samplerate = sf.read(self.path)
+        else:
+            self.data, self.samplerate = data, samplerate
+        # cavity and ramp stay views of data, samples are multiplied by scale only where segments are cut out
+        self.scale = scale
         self.cavity = self.data[:, 0]
         self.ramp = self.data[:, 1]
         self.time = np.arange(len(self.data)) / self.samplerate  # Compute time axis\
         self.frequency = np.linspace(start_freq, start_freq+sweep_width, num=len(self.cavity))
         self.segments = []
+        self.segment_table = np.zeros(0, dtype=SEGMENT_DTYPE)  # One row per segment, filled by segment_capture_data
+        self._frequency_axes = {}
         self.fit_arrays = dict()
+        self.fit_results = np.zeros(0, dtype=FIT_DTYPE)  # One row per segment, filled by fit_fano
+        self.sweep_detector = None
 
         print(f"Capture was {self.time[-1]} seconds long")
         print(f"Center freq of {np.mean(self.frequency)} GHz")
@@ -70,67 +407,132 @@ class ResonanceAnalyzer:
             plt.plot(self.time, self.data)
             plt.show()
 
+    @classmethod
+    def from_store(cls, store, name, plot=False):
+        # Sweep parameters come from the capture's metadata. The int16 memmap is used as is and
+        # scaled like sf.read per segment, so the capture is never copied as a whole.
+        record = store.metadata(name)
+        return cls(name, record["stop_freq"] - record["start_freq"], start_freq=record["start_freq"], plot=plot,
+                   data=store.open(name), samplerate=record["samplerate"], scale=1 / 32768.0)
+
     def convert_to_voltage(self):
-        self.cavity = self.cavity * 20
-        self.ramp = self.ramp * 20
-
-    def segment_capture_data(self, plot_segments=[], distance=300, window_size=100):
-        kernel = np.ones(int(window_size)) / window_size
-        ramp = np.convolve(self.ramp, kernel, mode='valid')
-        peak_indices, _ = find_peaks(ramp, distance=distance) # distance=1 means strict local maxima
-        valley_indices, _ = find_peaks(-ramp, distance=distance) # distance=1 means strict local minima
-
-        turning_point_indices = np.union1d(peak_indices, valley_indices)
-        turning_point_indices = np.union1d(turning_point_indices, [0, len(ramp) - 1])
-        turning_point_indices = np.sort(turning_point_indices).astype(int)
-
-        for i in range(len(turning_point_indices) - 1):
-            start_idx = turning_point_indices[i]
-            end_idx = turning_point_indices[i+1]
-            ramp_segment = ramp[start_idx : end_idx + 1].tolist()
-            cavity_segment = self.cavity[start_idx: end_idx + 1].tolist()
-            frequency_segment = np.linspace(self.start_freq, self.start_freq + self.sweep_width,
-                                            num=len(cavity_segment))
-            time_segment = self.time[start_idx: end_idx +1].tolist()
-            if np.max(ramp_segment) - np.min(ramp_segment) > 2.0 and ramp_segment[0] < ramp_segment[-1]:
-                self.segments.append(SweepSegment(cavity_segment, ramp_segment, frequency_segment, time_segment))
+        self.scale *= 20
+
+    def frequency_axis(self, length):
+        # Every sweep covers the same span, so segments of equal length share one read-only axis
+        axis = self._frequency_axes.get(length)
+        if axis is None:
+            axis = np.linspace(self.start_freq, self.start_freq + self.sweep_width, num=length)
+            axis.flags.writeable = False
+            self._frequency_axes[length] = axis
+        return axis
+
+    def segment_capture_data(self, plot_segments=[], window_size=None, hysteresis=0.25):
+        # window_size=None derives the smoothing window from the estimated sweep period
+        ramp, turning_point_indices, self.sweep_detector = detect_turning_points(self.ramp, window_size, hysteresis)
+        ramp *= self.scale  # The smoothed ramp is a new float array, turning points do not depend on the scale
+        if self.sweep_detector.period:
+            print(f"Sweep period of {self.sweep_detector.period / self.samplerate} seconds, "
+                  f"smoothing over {self.sweep_detector.window_size} samples")
+
+        # Keep sweeps that cover most of the ramp and go upwards, checked for all of them at once
+        starts = turning_point_indices[:-1]
+        stops = turning_point_indices[1:]
+        ramp_max = np.maximum(np.maximum.reduceat(ramp, starts), ramp[stops])
+        ramp_min = np.minimum(np.minimum.reduceat(ramp, starts), ramp[stops])
+        keep = (ramp_max - ramp_min > 2.0) & (ramp[starts] < ramp[stops])
+
+        for start_idx, end_idx in zip(starts[keep].tolist(), stops[keep].tolist()):
+            cavity = self.cavity[start_idx: end_idx + 1] * self.scale
+            self.segments.append(SweepSegment(cavity, ramp[start_idx: end_idx + 1],
+                                              self.frequency_axis(end_idx + 1 - start_idx),
+                                              self.time[start_idx: end_idx + 1], start_idx, end_idx))
+        self.segment_table = np.zeros(len(self.segments), dtype=SEGMENT_DTYPE)
+        for row, segment in zip(self.segment_table, self.segments):
+            row["start"], row["stop"], row["mean_time"] = segment.start, segment.stop, segment.mean_time
+            row["center"], row["reversed"] = segment.center, segment.reversed
 
         for i in plot_segments:
             plt.plot(self.segments[i].ramp)
             plt.plot(self.segments[i].cavity)
             plt.show()
 
-    def fit_fano(self, fit_segments=[], plot=False):
-        for segment_idx in fit_segments:
-            segment = self.segments[segment_idx]
-            segment.fit_fano(plot=plot)
+    def fit_fano(self, fit_segments=[], plot=False, processes=None, warm_start=True, method="batched", cache=None):
+        self.fit_results = np.zeros(len(self.segments), dtype=FIT_DTYPE)
+        self.fit_results["segment"] = np.arange(len(self.segments))
+        if plot:
+            # Serial so every fit can be shown as it completes
+            for segment_idx in fit_segments:
+                segment = self.segments[segment_idx]
+                segment.fit_fano(plot=plot)
+                row = self.fit_results[segment_idx]
+                row["fitted"], row["success"], row["rsquared"] = True, segment.result.success, segment.rsquared
+                for name in FIT_PARAMETERS:
+                    row[name] = segment.best_values[name]
+            return
+        if cache is not None:
+            # Segments fitted before with the same samples, model and settings are not fitted again
+            keys = {}
+            for segment_idx in fit_segments:
+                segment = self.segments[segment_idx]
+                x_arr = segment.frequency - segment.frequency[0]
+                keys[segment_idx] = cache.key(x_arr, segment.cavity, method=method, warm_start=warm_start,
+                                              **initial_guess(x_arr, segment.cavity))
+            cached = cache.get_many(keys.values())
+            for segment_idx, key in keys.items():
+                if key in cached:
+                    self.fit_results[segment_idx] = cached[key]
+                    self.fit_results[segment_idx]["segment"] = segment_idx
+            fit_segments = [segment_idx for segment_idx, key in keys.items() if key not in cached]
+            print(f"{len(cached)} fits loaded from the cache, {len(fit_segments)} to fit")
+        independent = self.fit_segments_uncached(fit_segments, processes, warm_start, method)
+        if cache is not None:
+            # A warm-started fit depends on the segment fitted before it, which is not part of the key
+            cache.put_many((keys[segment_idx], self.fit_results[segment_idx]) for segment_idx in independent)
+
+    def fit_segments_uncached(self, fit_segments, processes=None, warm_start=True, method="batched"):
+        # Returns the segments whose fit only depends on their own samples (everything unless warm started)
+        independent = list(fit_segments) if not warm_start else []
+        engine = FanoFitEngine(processes=processes, warm_start=warm_start)
+        if method == "batched":
+            # Equal-length segments are solved together, anything that does not converge goes to lmfit
+            fallback = []
+            by_length = {}
+            for segment_idx in fit_segments:
+                by_length.setdefault(len(self.segments[segment_idx].cavity), []).append(segment_idx)
+            for indices in by_length.values():
+                x_arrays = [np.asarray(self.segments[i].frequency) - self.segments[i].frequency[0] for i in indices]
+                cavities = [self.segments[i].cavity for i in indices]
+                results, converged = fit_fano_batched(indices, x_arrays, cavities)
+                self.fit_results[results["segment"][converged]] = results[converged]
+                fallback.extend(results["segment"][~converged].tolist())
+                if warm_start:
+                    independent.extend(results["segment"][converged].tolist())  # Batched fits never warm start
+            fit_segments = sorted(fallback)
+            if fit_segments:
+                print(f"{len(fit_segments)} segments did not converge in the batched solver, refitting with lmfit")
+        results = engine.fit(self.segments, fit_segments)
+        self.fit_results[results["segment"]] = results
+        return independent
 
     def construct_fit_array(self, collect_segments=[]):
-        #self.fit_arrays["c"] = []
-        self.fit_arrays["amplitude"] = []
-        self.fit_arrays["center"] = []
-        self.fit_arrays["sigma"] = []
-        self.fit_arrays["q"] = []
+        rows = self.fit_results[list(collect_segments)]
+        start_frequencies = np.array([self.segments[i].frequency[0] for i in collect_segments])
+        #self.fit_arrays["c"] = rows["c"]
+        self.fit_arrays["amplitude"] = rows["amplitude"]
+        self.fit_arrays["center"] = rows["center"] + start_frequencies
+        self.fit_arrays["sigma"] = rows["sigma"]
+        self.fit_arrays["q"] = rows["q"]
         self.fit_arrays["segments"] = collect_segments
-        for collect_idx in collect_segments:
-            segment = self.segments[collect_idx]
-            #self.fit_arrays["c"].append(segment.best_values["c"])
-            self.fit_arrays["amplitude"].append(segment.best_values["amplitude"])
-            self.fit_arrays["center"].append(segment.best_values["center"] + segment.frequency[0])
-            self.fit_arrays["sigma"].append(segment.best_values["sigma"])
-            self.fit_arrays["q"].append(segment.best_values["q"])
 
     def construct_r_squared_array(self, collect_segments=[]):
-        self.r_squareds = []
-        for segment_idx in collect_segments:
-            segment = self.segments[segment_idx]
-            self.r_squareds.append(segment.result.rsquared)
+        self.r_squareds = self.fit_results["rsquared"][list(collect_segments)]
 
     def construct_quality_factor_array(self, collect_segments=[]):
         self.quality_factors = []
         for segment_idx in collect_segments:
             segment = self.segments[segment_idx]
-            segment.calculate_quality_factor()
+            segment.calculate_quality_factor(self.fit_results["sigma"][segment_idx])
             self.quality_factors.append(segment.quality_factor)
 
     def construct_mean_time_array(self, collect_segments=[]):
@@ -225,7 +627,7 @@ class ResonanceAnalyzer:
         plt.xlabel("Seconds")
         plt.ylabel("Quality Factor")
 
-    def run_analysis(self, target_segments=None, plot_segment=False, plot_fit=False):
+    def run_analysis(self, target_segments=None, plot_segment=False, plot_fit=False, cache=None):
         self.convert_to_voltage()
         self.segment_capture_data()
         print(f"{len(self.segments)} segments found")
@@ -234,39 +636,172 @@ class ResonanceAnalyzer:
 
         if plot_segment:
             analyzer.segment_capture_data(plot_segments=target_segments)
-        self.fit_fano(fit_segments=target_segments, plot=plot_fit)
+        self.fit_fano(fit_segments=target_segments, plot=plot_fit, cache=cache)
         self.construct_fit_array(collect_segments=target_segments)
         self.construct_quality_factor_array(collect_segments=target_segments)
         self.construct_mean_time_array(collect_segments=target_segments)
         self.construct_r_squared_array(collect_segments=target_segments)
         self.construct_center_array(collect_segments=target_segments)
 
-#analyzer = ResonanceAnalyzer("ResonanceCaptures/Saves/Capture4.wav", 30, start_freq=209.6e3)
-sigmas = []
-with open("ResonanceCaptures/Saves/metadata.json") as f:
-    data = json.load(f)
-for target_file in ["data_file_10.120.12.199_2025-08-19_18-28-03.wav"]:
-    #target_data = data[target_file]
-    #analyzer = ResonanceAnalyzer(f"ResonanceCaptures/Saves/{target_file}.wav", target_data["stop_freq"]-target_data["start_freq"],
-                                 #start_freq=target_data["start_freq"])
-    analyzer = ResonanceAnalyzer(f"ResonanceCaptures/Saves/{target_file}", 25, 194544, plot=False)
-    #target_segments = [i for i in range(0, 15)]
-    target_segments=[i for i in range(200)]
-    analyzer.run_analysis(target_segments, plot_fit=False)
-
-    ## Plotting
-    #analyzer.plot_c()
-    # The fano-ness of it. positive -> left side lower
-    #analyzer.plot_q()
-    #analyzer.plot_amplitude()
-    analyzer.plot_center()
-    analyzer.plot_fit_center()
-    analyzer.plot_center_fft()
-    analyzer.plot_quality_factor()
-    analyzer.plot_r_squared()
-    #FWHM
-    analyzer.plot_sigma()
-    sigmas.append(np.mean(analyzer.fit_arrays["sigma"]))
-    plt.show()
+class IncrementalResonanceAnalyzer:
+    # Same segmentation and fits as ResonanceAnalyzer, but fed block by block (sf.blocks or
+    # RP_Streamer.iter_chunks) so sweeps are fitted as soon as they complete. Only the current,
+    # unfinished sweep is kept in memory.
+    frequency_axis = ResonanceAnalyzer.frequency_axis
+
+    def __init__(self, sweep_width, samplerate, start_freq=0.0, window_size=None, hysteresis=0.25, method="batched",
+                 calibration_samples=1 << 17, max_buffer=1 << 22):
+        self.sweep_width = sweep_width
+        self.samplerate = samplerate
+        self.start_freq = start_freq
+        self.window_size = window_size
+        self.hysteresis = hysteresis
+        self.method = method
+        self.calibration_samples = calibration_samples  # Ramp levels and period are estimated from these
+        self.max_buffer = max_buffer  # Samples kept if no turning point shows up (ramp off, no lock)
+        self._frequency_axes = {}
+        self.segments_found = 0
+        self.reset()
+
+    def reset(self):
+        self.detector = SweepDetector(self.window_size, self.hysteresis)
+        self._calibration_blocks = []
+        self._ramp = np.zeros(0)  # Smoothed ramp since the last confirmed turning point
+        self._cavity = np.zeros(0)
+        self._offset = 0  # Capture sample index of _ramp[0] and _cavity[0]
+        self._aligned = False  # Whether the start of _ramp has been padded to line up with _cavity
+
+    def feed(self, block):
+        # block: (samples, 2) cavity/ramp, int16 counts or floats scaled like sf.read. Returns the
+        # SweepSegments completed by this block, already fitted.
+        block = np.asarray(block)
+        if block.dtype == np.int16:
+            block = block / 32768.0
+        block = block[:, :2] * 20
+        if not self.detector.calibrated:
+            self._calibration_blocks.append(block)
+            if sum(len(b) for b in self._calibration_blocks) < self.calibration_samples:
+                return []
+            block = np.concatenate(self._calibration_blocks)
+            self._calibration_blocks = []
+            self.detector.calibrate(block[:, 1])
+        return self._process(block)
+
+    def _process(self, block):
+        self._cavity = np.concatenate([self._cavity, block[:, 0]])
+        smoothed = self.detector.smooth(block[:, 1])
+        turning_points = np.asarray(self.detector.update(smoothed), dtype=int) + self.detector.delay - self._offset
+        if not self._aligned and len(smoothed):
+            # Smoothed sample i belongs to capture sample i + delay, same edge padding as SweepDetector.align
+            smoothed = np.concatenate([np.full(self.detector.delay, smoothed[0]), smoothed])
+            self._aligned = True
+        self._ramp = np.concatenate([self._ramp, smoothed])
+        segments = self._complete(np.concatenate([[0], turning_points]).astype(int))
+        if len(self._ramp) > self.max_buffer:
+            self._drop(len(self._ramp) - self.max_buffer)
+        return segments
+
+    def flush(self):
+        # The end of the capture counts as a turning point, like in ResonanceAnalyzer
+        segments = []
+        if self._calibration_blocks:
+            # Shorter than calibration_samples, calibrate on what there is
+            block = np.concatenate(self._calibration_blocks)
+            self._calibration_blocks = []
+            self.detector.calibrate(block[:, 1])
+            segments += self._process(block)
+        if len(self._ramp) > 1:
+            self._ramp = np.pad(self._ramp, (0, len(self._cavity) - len(self._ramp)), mode="edge")
+            turning_points = np.asarray(self.detector.finish(), dtype=int) + self.detector.delay - self._offset
+            segments += self._complete(np.union1d(np.concatenate([[0], turning_points]), [len(self._ramp) - 1]))
+        self.reset()
+        return segments
+
+    def iter_blocks(self, blocks):
+        for block in blocks:
+            yield from self.feed(block)
+        yield from self.flush()
+
+    def iter_file(self, path, blocksize=65536):
+        yield from self.iter_blocks(sf.blocks(path, blocksize=blocksize, always_2d=True))
+
+    def _complete(self, turning_points):
+        segments = []
+        for start_idx, end_idx in zip(turning_points[:-1].tolist(), turning_points[1:].tolist()):
+            ramp_segment = self._ramp[start_idx: end_idx + 1]
+            if np.max(ramp_segment) - np.min(ramp_segment) > 2.0 and ramp_segment[0] < ramp_segment[-1]:
+                start = self._offset + start_idx
+                time_segment = np.arange(start, start + len(ramp_segment)) / self.samplerate
+                segments.append(SweepSegment(self._cavity[start_idx: end_idx + 1].copy(), ramp_segment.copy(),
+                                             self.frequency_axis(len(ramp_segment)), time_segment, start,
+                                             start + len(ramp_segment) - 1))
+        if len(turning_points) > 1:
+            self._drop(turning_points[-1])
+        self._fit(segments)
+        return segments
+
+    def _drop(self, samples):
+        self._ramp = self._ramp[samples:]
+        self._cavity = self._cavity[samples:]
+        self._offset += int(samples)
+
+    def _fit(self, segments):
+        if not segments:
+            return
+        indices = list(range(self.segments_found, self.segments_found + len(segments)))
+        self.segments_found += len(segments)
+        x_arrays = [segment.frequency - segment.frequency[0] for segment in segments]
+        cavities = [segment.cavity for segment in segments]
+        rows = np.zeros(len(segments), dtype=FIT_DTYPE)
+        pending = np.ones(len(segments), dtype=bool)
+        if self.method == "batched":
+            by_length = {}
+            for row, segment in enumerate(segments):
+                by_length.setdefault(len(segment.cavity), []).append(row)
+            for group in by_length.values():
+                results, converged = fit_fano_batched([indices[i] for i in group], [x_arrays[i] for i in group],
+                                                      [cavities[i] for i in group])
+                group = np.array(group)
+                rows[group[converged]] = results[converged]
+                pending[group[converged]] = False
+        if pending.any():
+            remaining = np.flatnonzero(pending)
+            rows[remaining] = fit_fano_run(([indices[i] for i in remaining], [x_arrays[i] for i in remaining],
+                                            [cavities[i] for i in remaining], False, 0.5))
+        for segment, row in zip(segments, rows):
+            segment.best_values = {name: row[name] for name in FIT_PARAMETERS}
+            segment.rsquared = row["rsquared"]
+            segment.calculate_quality_factor()
 
 
+if __name__ == "__main__":
+    #analyzer = ResonanceAnalyzer("ResonanceCaptures/Saves/Capture4.wav", 30, start_freq=209.6e3)
+    store = CaptureStore()
+    # WAV captures from before the capture store, imported once with their sweep parameters
+    saved_captures = {"data_file_10.120.12.199_2025-08-19_18-28-03.wav": (194544, 194544 + 25)}
+    for target_file, (start_freq, stop_freq) in saved_captures.items():
+        if not store.query(source=target_file):
+            store.import_wav(f"ResonanceCaptures/Saves/{target_file}", start_freq=start_freq, stop_freq=stop_freq)
+
+    sigmas = []
+    cache = open_fit_cache()
+    for target_file in store.query(start_freq=lambda f: f is not None, stop_freq=lambda f: f is not None):
+        analyzer = ResonanceAnalyzer.from_store(store, target_file, plot=False)
+        #target_segments = [i for i in range(0, 15)]
+        target_segments=[i for i in range(200)]
+        analyzer.run_analysis(target_segments, plot_fit=False, cache=cache)
+
+        ## Plotting
+        #analyzer.plot_c()
+        # The fano-ness of it. positive -> left side lower
+        #analyzer.plot_q()
+        #analyzer.plot_amplitude()
+        analyzer.plot_center()
+        analyzer.plot_fit_center()
+        analyzer.plot_center_fft()
+        analyzer.plot_quality_factor()
+        analyzer.plot_r_squared()
+        #FWHM
+        analyzer.plot_sigma()
+        sigmas.append(np.mean(analyzer.fit_arrays["sigma"]))
+        plt.show()
@@ -0,0 +1,161 @@
+import argparse
+import datetime
+import glob
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from analyze_linewidth import ResonanceAnalyzer, open_fit_cache
+from capture_store import CaptureStore
+
+# Runs the linewidth analysis over every capture we have and collects one row per fitted segment
+# into a single table. Each capture is written to its own part file as soon as it is done, so an
+# interrupted run picks up where it stopped and only the new captures are analyzed next time.
+RESULT_COLUMNS = ("capture", "timestamp", "segment", "start", "stop", "mean_time", "center", "fit_center", "sigma", "q",
+                  "amplitude", "intercept", "slope", "rsquared", "success", "quality_factor")
+
+
+def load_saves_metadata(saves_dir):
+    # metadata.json maps capture names (with or without .wav) to {"start_freq": ..., "stop_freq": ...}
+    path = os.path.join(saves_dir, "metadata.json")
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def discover_captures(saves_dir="ResonanceCaptures/Saves", store=None):
+    # Jobs as (name, kind, location, start_freq, stop_freq, timestamp). Captures in the store win over
+    # the WAV they were imported from.
+    jobs = []
+    imported = set()
+    if store is not None:
+        for name in store.query(start_freq=lambda f: f is not None, stop_freq=lambda f: f is not None):
+            record = store.metadata(name)
+            jobs.append((name, "store", store.root, record["start_freq"], record["stop_freq"], record.get("timestamp")))
+            if record.get("source"):
+                imported.add(record["source"])
+    metadata = load_saves_metadata(saves_dir)
+    for path in sorted(glob.glob(os.path.join(saves_dir, "*.wav"))):
+        filename = os.path.basename(path)
+        if filename in imported:
+            continue
+        stem = os.path.splitext(filename)[0]
+        record = metadata.get(filename, metadata.get(stem))
+        if not record or record.get("start_freq") is None or record.get("stop_freq") is None:
+            print(f"Skipping {filename}, no sweep parameters in metadata.json")
+            continue
+        timestamp = record.get("timestamp") or datetime.datetime.fromtimestamp(
+            os.path.getmtime(path)).isoformat(timespec="seconds")
+        jobs.append((stem, "wav", path, record["start_freq"], record["stop_freq"], timestamp))
+    return jobs
+
+
+def part_path(output_dir, name):
+    return os.path.join(output_dir, "parts", f"{name}.npz")
+
+
+def analyze_capture(job, output_dir, cache_path=None, method="batched"):
+    # Worker: fits every segment of one capture and writes its part file, returns the part path
+    name, kind, location, start_freq, stop_freq, timestamp = job
+    if kind == "store":
+        analyzer = ResonanceAnalyzer.from_store(CaptureStore(location), name)
+    else:
+        analyzer = ResonanceAnalyzer(location, stop_freq - start_freq, start_freq=start_freq)
+    analyzer.convert_to_voltage()
+    analyzer.segment_capture_data()
+    segments = list(range(len(analyzer.segments)))
+    cache = open_fit_cache(cache_path) if cache_path else None
+    try:
+        analyzer.fit_fano(fit_segments=segments, processes=1, method=method, cache=cache)
+    finally:
+        if cache is not None:
+            cache.close()
+    analyzer.construct_quality_factor_array(collect_segments=segments)
+
+    rows = analyzer.fit_results
+    table = analyzer.segment_table
+    columns = {
+        "capture": np.full(len(segments), name),
+        "timestamp": np.full(len(segments), timestamp or ""),
+        "segment": rows["segment"],
+        "start": table["start"],
+        "stop": table["stop"],
+        "mean_time": table["mean_time"],
+        "center": table["center"],  # Frequency of the cavity minimum
+        "fit_center": rows["center"] + start_freq,
+        "quality_factor": np.asarray(analyzer.quality_factors, dtype=np.float64),
+    }
+    for column in ("sigma", "q", "amplitude", "intercept", "slope", "rsquared", "success"):
+        columns[column] = rows[column]
+
+    path = part_path(output_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(f, **columns)
+    os.replace(temp_path, path)  # A part file only exists once the capture is completely analyzed
+    return path
+
+
+def combine_parts(output_dir, output_format="npz"):
+    columns = {column: [] for column in RESULT_COLUMNS}
+    for path in sorted(glob.glob(os.path.join(output_dir, "parts", "*.npz"))):
+        with np.load(path) as part:
+            for column in RESULT_COLUMNS:
+                columns[column].append(part[column])
+    columns = {column: np.concatenate(values) if values else np.zeros(0) for column, values in columns.items()}
+    if output_format == "parquet":
+        import pandas as pd  # Optional, only needed for Parquet output (with pyarrow or fastparquet)
+        path = os.path.join(output_dir, "results.parquet")
+        pd.DataFrame(columns).to_parquet(path)
+    else:
+        path = os.path.join(output_dir, "results.npz")
+        np.savez(path, **columns)
+    return path
+
+
+def run_batch(jobs, output_dir="ResonanceCaptures/Analysis", processes=None, cache_path=None, force=False,
+              output_format="npz", method="batched"):
+    pending = [job for job in jobs if force or not os.path.exists(part_path(output_dir, job[0]))]
+    print(f"{len(jobs)} captures, {len(jobs) - len(pending)} already analyzed, {len(pending)} to go")
+    failed = []
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count() or 1) as pool:
+        futures = {pool.submit(analyze_capture, job, output_dir, cache_path, method): job for job in pending}
+        for done, future in enumerate(as_completed(futures), start=1):
+            name = futures[future][0]
+            try:
+                future.result()
+                print(f"[{done}/{len(pending)}] {name} done")
+            except Exception:
+                # One bad capture should not stop an overnight run, it is retried next time
+                failed.append(name)
+                print(f"[{done}/{len(pending)}] {name} failed")
+                traceback.print_exc()
+    path = combine_parts(output_dir, output_format)
+    print(f"Results written to {path}")
+    if failed:
+        print(f"{len(failed)} captures failed: {', '.join(failed)}")
+    return path, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit every resonance capture and collect the results")
+    parser.add_argument("--saves", default="ResonanceCaptures/Saves", help="Directory of WAV captures")
+    parser.add_argument("--store", default="ResonanceCaptures/Store", help="Capture store root, '' to skip")
+    parser.add_argument("--output", default="ResonanceCaptures/Analysis")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--cache", default="ResonanceCaptures/fit_cache.sqlite", help="Fit cache, '' to disable")
+    parser.add_argument("--format", choices=["npz", "parquet"], default="npz")
+    parser.add_argument("--method", choices=["batched", "lmfit"], default="batched")
+    parser.add_argument("--force", action="store_true", help="Reanalyze captures that already have results")
+    args = parser.parse_args()
+
+    store = CaptureStore(args.store) if args.store else None
+    jobs = discover_captures(args.saves, store)
+    run_batch(jobs, args.output, args.processes, args.cache or None, args.force, args.format, args.method)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import datetime
+import json
+import os
+import numpy as np
+import soundfile as sf
+
+# Raw little-endian int16 sample files, (samples, channels) interleaved, plus one JSON index
+# recording how each capture was taken. Readers get np.memmap views so opening a capture is O(1).
+SAMPLE_DTYPE = np.dtype("<i2")
+INDEX_FILENAME = "index.json"
+
+
+class CaptureWriter:
+    # Appends chunks to a capture as they arrive. close() adds the capture to the index, abort()
+    # (or leaving the with block through an exception) deletes the partial file instead.
+    def __init__(self, store, name, record):
+        self.store = store
+        self.name = name
+        self.record = record
+        self.samples = 0
+        self.file = open(store.data_path(name), "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, chunk):
+        chunk = np.asarray(chunk)
+        if chunk.ndim == 1:
+            chunk = chunk[:, None]
+        if chunk.shape[1] != self.record["channels"]:
+            raise ValueError(f"Expected {self.record['channels']} channels, got {chunk.shape[1]}")
+        np.ascontiguousarray(chunk, dtype=SAMPLE_DTYPE).tofile(self.file)
+        self.samples += len(chunk)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        self.record["samples"] = self.samples
+        self.store.add_record(self.name, self.record)
+
+    def abort(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        os.remove(self.store.data_path(self.name))
+
+
+class CaptureStore:
+    def __init__(self, root="ResonanceCaptures/Store"):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.index_path = os.path.join(root, INDEX_FILENAME)
+        self.index = self.load_index()
+
+    def load_index(self):
+        if not os.path.exists(self.index_path) or os.path.getsize(self.index_path) == 0:
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def save_index(self):
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.index, f, indent=4)
+        os.replace(temp_path, self.index_path)  # Never leave a half written index behind
+
+    def add_record(self, name, record):
+        self.index = self.load_index()  # Pick up captures written by other processes
+        self.index[name] = record
+        self.save_index()
+
+    def data_path(self, name):
+        return os.path.join(self.root, f"{name}.i16")
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def new_record(self, channels, samplerate, decimation=None, pid_gains=None, start_freq=None, stop_freq=None,
+                   timestamp=None, **metadata):
+        if timestamp is None:
+            timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+        if pid_gains is not None:
+            # {channel: (p, i, d, set_point)} as JSON friendly values
+            pid_gains = {str(channel): [int(value) for value in gains] for channel, gains in pid_gains.items()}
+        return {
+            "dtype": SAMPLE_DTYPE.str,
+            "channels": int(channels),
+            "samples": 0,
+            "samplerate": float(samplerate),
+            "decimation": decimation,
+            "pid_gains": pid_gains,
+            "start_freq": start_freq,
+            "stop_freq": stop_freq,
+            "timestamp": timestamp,
+            **metadata,
+        }
+
+    def unique_name(self, name=None):
+        if name is None:
+            name = "capture_" + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        candidate, suffix = name, 1
+        while candidate in self.index or os.path.exists(self.data_path(candidate)):
+            candidate = f"{name}_{suffix}"
+            suffix += 1
+        return candidate
+
+    def writer(self, channels, samplerate, name=None, **metadata):
+        name = self.unique_name(name)
+        return CaptureWriter(self, name, self.new_record(channels, samplerate, **metadata))
+
+    def save(self, data, samplerate, name=None, **metadata):
+        data = np.asarray(data)
+        channels = 1 if data.ndim == 1 else data.shape[1]
+        with self.writer(channels, samplerate, name=name, **metadata) as writer:
+            writer.write(data)
+        return writer.name
+
+    def import_wav(self, path, name=None, block_size=1 << 20, **metadata):
+        # Converts a WAV capture block by block, never holding the whole file
+        info = sf.info(path)
+        if name is None:
+            name = os.path.splitext(os.path.basename(path))[0]
+        with self.writer(info.channels, info.samplerate, name=name, source=os.path.basename(path),
+                         **metadata) as writer:
+            for block in sf.blocks(path, blocksize=block_size, dtype="int16", always_2d=True):
+                writer.write(block)
+        return writer.name
+
+    def metadata(self, name):
+        return self.index[name]
+
+    def open(self, name):
+        # Zero-copy, read-only (samples, channels) view of the raw int16 data
+        record = self.index[name]
+        if record["samples"] == 0:
+            return np.zeros((0, record["channels"]), dtype=SAMPLE_DTYPE)
+        return np.memmap(self.data_path(name), dtype=record["dtype"], mode="r",
+                         shape=(record["samples"], record["channels"]))
+
+    def query(self, **criteria):
+        # Each criterion is either a value to match exactly or a predicate on the field,
+        # e.g. store.query(samplerate=122070.0, start_freq=lambda f: f is not None and f > 194e3)
+        names = []
+        for name, record in self.index.items():
+            for field, expected in criteria.items():
+                value = record.get(field)
+                if callable(expected):
+                    if not expected(value):
+                        break
+                elif value != expected:
+                    break
+            else:
+                names.append(name)
+        return sorted(names, key=lambda name: self.index[name].get("timestamp") or "")
@@ -0,0 +1,85 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    import pandas as pd  # Its C parser releases the GIL, so chunks parse in parallel threads
+except ImportError:
+    pd = None
+
+# Loads the capture CSVs written by the C tools and capture scripts (one value per row, or
+# "time, raw" pairs, with or without a header row). The first load parses the text in chunks and
+# saves a .npy sidecar next to the CSV, later loads memory-map the sidecar instead of parsing again.
+CHUNK_BYTES = 16 << 20
+
+
+def sidecar_path(path):
+    return path + ".npy"
+
+
+def has_header(path):
+    with open(path, "rb") as f:
+        first = f.readline().decode(errors="replace").strip()
+    try:
+        [float(value) for value in first.split(",") if value.strip()]
+        return False
+    except ValueError:
+        return True
+
+
+def byte_ranges(path, start, chunk_bytes):
+    # Splits the file into ranges that end on line boundaries
+    size = os.path.getsize(path)
+    bounds = [start]
+    with open(path, "rb") as f:
+        position = start + chunk_bytes
+        while position < size:
+            f.seek(position)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+            position = f.tell() + chunk_bytes
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def parse_range(path, start, stop):
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(stop - start)
+    if not text.strip():
+        return np.zeros((0, 0))
+    if pd is not None:
+        return pd.read_csv(io.BytesIO(text), header=None, dtype=np.float64, engine="c").to_numpy()
+    return np.loadtxt(io.BytesIO(text), delimiter=",", ndmin=2)
+
+
+def parse_csv(path, header=None, workers=None, chunk_bytes=CHUNK_BYTES):
+    if header is None:
+        header = has_header(path)
+    start = 0
+    if header:
+        with open(path, "rb") as f:
+            f.readline()
+            start = f.tell()
+    ranges = byte_ranges(path, start, chunk_bytes)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        chunks = [chunk for chunk in pool.map(lambda r: parse_range(path, *r), ranges) if chunk.size]
+    data = np.concatenate(chunks) if chunks else np.zeros((0, 1))
+    return data[:, 0] if data.shape[1] == 1 else data
+
+
+def load_csv(path, header=None, sidecar=True, mmap=True):
+    # (rows,) for single column files, (rows, columns) otherwise. header=None detects a header row.
+    cache = sidecar_path(path)
+    if sidecar and os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return np.load(cache, mmap_mode="r" if mmap else None)
+    data = parse_csv(path, header)
+    if sidecar:
+        temp_path = cache + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, data)
+        os.replace(temp_path, cache)
+    return data
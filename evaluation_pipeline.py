@@ -0,0 +1,102 @@
+import concurrent.futures
+import os
+import threading
+import numpy as np
+
+
+# Plotting runs in worker processes, these have to stay importable without side effects
+def plot_capture(path, data, rate, title):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    plt.figure(figsize=(8, 6))
+    time = np.arange(len(data)) / rate
+    plt.plot(time, data)
+    plt.xlabel("Time")
+    plt.ylabel("Signal")
+    plt.title(title)
+    plt.ylim(0, 1)
+    plt.grid()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    plt.savefig(path)
+    plt.close()
+
+
+def plot_fitness_history(path, fitness_history):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    plt.figure()
+    plt.plot(fitness_history)
+    plt.savefig(path)
+    plt.close()
+
+
+class PipelinedEvaluator:
+    # Keeps the hardware busy: the calling thread only applies gains and captures, scoring runs on a
+    # worker thread (capture of candidate N+1 overlaps scoring of N), and PNGs are drawn in a process pool.
+    def __init__(self, apply_solution, capture, fitness, describe, log_dir, log_file, plot_workers=2):
+        self.apply_solution = apply_solution  # solution -> None, sets the gains
+        self.capture = capture  # () -> (data, rate), or (data, rate, fitness) when the capture already scored it
+        self.fitness = fitness  # (data, rate) -> float
+        self.describe = describe  # solution -> text for the log
+        self.log_dir = log_dir
+        self.log_file = log_file
+        self.fitness_history = []
+        self.score_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.log_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)  # Keeps log lines in order
+        self.plot_pool = concurrent.futures.ProcessPoolExecutor(max_workers=plot_workers)
+        self.background = []
+        self.background_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def evaluate_batch(self, solutions, solution_indices, generation):
+        self.drain()
+        scores = []
+        for solution, solution_idx in zip(solutions, solution_indices):
+            self.apply_solution(solution)
+            captured = self.capture()
+            scores.append(self.score_pool.submit(self.score, *captured[:2], solution, solution_idx, generation,
+                                                 *captured[2:]))
+        return [score.result() for score in scores]
+
+    def score(self, data, rate, solution, solution_idx, generation, fitness=None):
+        if fitness is None:
+            fitness = self.fitness(data, rate)
+        self.fitness_history.append(fitness)
+        path = os.path.join(self.log_dir, f"Generation_{generation}", f"Idx_{solution_idx}.png")
+        title = f"Generation={generation}, Solution Index={solution_idx}, Fitness={fitness}"
+        log_entry = f"Generation: {generation}, Solution Index: {solution_idx}\n{self.describe(solution)}   Fitness: {fitness:.6f}\n"
+        with self.background_lock:
+            self.background.append(self.plot_pool.submit(plot_capture, path, data, rate, title))
+            self.background.append(self.plot_pool.submit(
+                plot_fitness_history, os.path.join(self.log_dir, "fitness.png"), list(self.fitness_history)))
+            self.background.append(self.log_pool.submit(self.write_log, log_entry))
+        return fitness
+
+    def write_log(self, log_entry):
+        print("-----------------------------------------")
+        print(log_entry)
+        with open(self.log_file, "a") as f:
+            f.write(log_entry)
+
+    def drain(self):
+        # Surface errors from plotting/logging and drop finished work
+        finished, pending = [], []
+        with self.background_lock:
+            for future in self.background:
+                (finished if future.done() else pending).append(future)
+            self.background = pending
+        for future in finished:
+            future.result()
+
+    def close(self):
+        self.score_pool.shutdown(wait=True)
+        self.log_pool.shutdown(wait=True)
+        self.plot_pool.shutdown(wait=True)
+        self.drain()
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import sqlite3
+import time
+import numpy as np
+
+# Fit results keyed by a hash of everything that determines them (samples, model, initial guesses),
+# so re-running an analysis only fits segments it has not seen. One SQLite file, safe to share
+# between the worker processes of a batch run, trimmed to the most recently used entries.
+DEFAULT_PATH = "ResonanceCaptures/fit_cache.sqlite"
+
+
+class FitCache:
+    def __init__(self, dtype, path=DEFAULT_PATH, max_entries=200000, signature=""):
+        self.dtype = np.dtype(dtype)  # Structured dtype of one cached row
+        self.path = path
+        self.max_entries = max_entries
+        # Rows written with another dtype or model would not mean the same thing, they simply miss
+        self.signature = f"{signature}|{self.dtype.descr}"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS fits (key BLOB PRIMARY KEY, row BLOB, used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS fits_used ON fits (used)")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __getstate__(self):
+        # Worker processes open their own connection
+        state = self.__dict__.copy()
+        del state["connection"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+
+    def key(self, *arrays, **parameters):
+        digest = hashlib.blake2b(self.signature.encode(), digest_size=20)
+        for array in arrays:
+            array = np.ascontiguousarray(array, dtype=np.float64)
+            digest.update(str(array.shape).encode())
+            digest.update(array.tobytes())
+        for name, value in sorted(parameters.items()):
+            if isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+                value = float(value)
+            digest.update(f"{name}={value!r};".encode())
+        return digest.digest()
+
+    def get_many(self, keys):
+        # {key: row} for the keys that are cached, hits are marked as recently used
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):  # SQLite limits the number of bound parameters
+            batch = keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            for key, row in self.connection.execute(f"SELECT key, row FROM fits WHERE key IN ({placeholders})", batch):
+                found[bytes(key)] = np.frombuffer(row, dtype=self.dtype)[0].copy()
+        if found:
+            now = time.time()
+            self.connection.executemany("UPDATE fits SET used = ? WHERE key = ?", [(now, key) for key in found])
+            self.connection.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        # items: iterable of (key, row)
+        now = time.time()
+        self.connection.executemany("INSERT OR REPLACE INTO fits VALUES (?, ?, ?)",
+                                    [(key, np.asarray(row, dtype=self.dtype).tobytes(), now) for key, row in items])
+        self.connection.commit()
+        self.evict()
+
+    def evict(self):
+        count = self.connection.execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute("DELETE FROM fits WHERE key IN (SELECT key FROM fits ORDER BY used LIMIT ?)",
+                                    (count - self.max_entries,))
+            self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+
+    def clear(self):
+        self.connection.execute("DELETE FROM fits")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,103 @@
+import numpy as np
+
+# Fitness metrics for the PID optimizers, computed together from one capture so the residual and
+# spectrum are only formed once. Works on float volts or on raw int16 counts: int16 samples are only
+# widened to float32, and setpoint, lock_value, lock_width and tolerance are in the data's units.
+# `scale` converts amplitude results to other units (e.g. volts per count), squared sums get scale^2.
+# `channel` picks one column of (samples, channels) captures, None scores all channels together.
+METRICS = ("rms", "std", "band_noise", "lock_fraction", "overshoot", "settling_time", "squared_error",
+           "squared_slope")
+SUMMED = ("squared_error", "squared_slope")  # Grow with the capture length, the others are per-sample averages
+
+# Named weightings of the metrics, the score is sum(weight * metric) and higher is better
+PRESETS = {
+    "distance": {"squared_error": -1, "squared_slope": -1},  # pid_optimize's original score
+    "std": {"std": -1},  # genetic_optimize's original score
+    "rms": {"rms": -1},
+    "band_noise": {"band_noise": -1},
+    "lock": {"lock_fraction": 1},
+    "step": {"overshoot": -1, "settling_time": -1},
+}
+
+
+def as_signal(data, channel=0):
+    # 1-D captures as they are, one column of (samples, channels) captures or all of them for channel=None
+    data = np.asarray(data)
+    return data[:, channel] if data.ndim > 1 and channel is not None else data
+
+
+def as_float32(signal):
+    return signal if signal.dtype == np.float32 else signal.astype(np.float32)
+
+
+def sum_squares(x):
+    # Single precision BLAS dot, several times faster than squaring and summing, relative error ~1e-6
+    return float(np.dot(x, x))
+
+
+def evaluate(data, samplerate=None, metrics=METRICS, setpoint=0.0, band=(10.0, 1000.0), lock_value=None,
+             lock_width=None, tolerance=None, scale=1.0, channel=0):
+    # {metric: value} for the requested metrics
+    signal = as_signal(data, channel)
+    results = {}
+    metrics = set(metrics)
+    residual = as_float32(signal) - np.float32(setpoint)
+    flat = residual.ravel()  # Sums over all channels when there are several
+    if "rms" in metrics:
+        results["rms"] = np.sqrt(sum_squares(flat) / len(flat)) * scale
+    if "squared_error" in metrics:
+        results["squared_error"] = sum_squares(flat) * scale ** 2
+    if "squared_slope" in metrics:
+        results["squared_slope"] = sum_squares(np.diff(residual, axis=0).ravel()) * scale ** 2
+    if "std" in metrics:
+        centered = flat - np.mean(flat)
+        results["std"] = np.sqrt(sum_squares(centered) / len(centered)) * scale
+    if "band_noise" in metrics:
+        # Integrated noise over the band from a single rectangular periodogram, same units as rms,
+        # the band power of several channels adds up
+        if samplerate is None:
+            raise ValueError("band_noise needs the sample rate")
+        import spectral  # Pulls in scipy, which the other metrics do not need on the board
+        power = np.abs(np.fft.rfft(residual - np.mean(residual, axis=0), axis=0)) ** 2
+        frequencies = spectral.rfft_frequencies(len(residual), samplerate)
+        mask = (frequencies >= band[0]) & (frequencies < band[1])
+        results["band_noise"] = float(np.sqrt(2 * np.sum(power[mask], dtype=np.float64))) / len(residual) * scale
+    if residual.ndim > 1 and metrics & {"overshoot", "settling_time"}:
+        raise ValueError("overshoot and settling_time need a single channel")
+    if "lock_fraction" in metrics:
+        lock_value = setpoint if lock_value is None else lock_value
+        if lock_width is None:
+            raise ValueError("lock_fraction needs lock_width")
+        results["lock_fraction"] = float(np.mean((signal > lock_value - lock_width) & (signal < lock_value + lock_width)))
+    if "overshoot" in metrics:
+        # Largest excursion past the setpoint relative to the size of the step towards it
+        step = -float(residual[0])
+        results["overshoot"] = 0.0 if step == 0 else max(float(np.max(residual * np.sign(step))), 0.0) / abs(step)
+    if "settling_time" in metrics:
+        if tolerance is None:
+            raise ValueError("settling_time needs tolerance")
+        outside = np.flatnonzero(np.abs(residual) > tolerance)
+        settled_at = 0 if len(outside) == 0 else int(outside[-1]) + 1
+        results["settling_time"] = settled_at / samplerate if samplerate else float(settled_at)
+    return results
+
+
+def make_fitness(weights="distance", **params):
+    # (data, samplerate, length) -> score for a preset name or a {metric: weight} dict, params go to
+    # evaluate(). With `length` the SUMMED metrics are scaled to a capture of that many samples, so
+    # the score of a shorter block is comparable to a full length capture.
+    if isinstance(weights, str):
+        weights = PRESETS[weights]
+    unknown = set(weights) - set(METRICS)
+    if unknown:
+        raise ValueError(f"Unknown fitness metrics: {', '.join(sorted(unknown))}")
+
+    def fitness(data, samplerate=None, length=None):
+        values = evaluate(data, samplerate, metrics=weights, **params)
+        if length is not None:
+            for metric in SUMMED:
+                if metric in values:
+                    values[metric] *= length / len(data)
+        return sum(weight * values[metric] for metric, weight in weights.items())
+
+    return fitness
@@ -1,8 +1,18 @@
 from remote_streaming import RP_Streamer
+from capture_store import CaptureStore
 import matplotlib.pyplot as plt
 stream = RP_Streamer("10.120.12.199", save_directory="./ResonanceCaptures")
+store = CaptureStore()
 captures = 2000000
-data, sample_rate = stream.capture_signal(captures)
+# Sweep range of the laser during the capture, analyze_linewidth.py only picks up captures that have it.
+# Update these whenever the sweep is changed.
+start_freq = 194544
+stop_freq = start_freq + 25
+name = stream.capture_to_store(store, captures, start_freq=start_freq, stop_freq=stop_freq)
+if name is None:
+    raise RuntimeError("Capture failed")
+data = store.open(name)
 plt.plot(data)
 plt.show()
-print("Done!")
\ No newline at end of file
+print(f"Saved capture {name}")
+print("Done!")
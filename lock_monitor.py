@@ -0,0 +1,284 @@
+import argparse
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import spectral
+from stream_receiver import StreamReceiver, FakeStreamingServer
+
+# Live lock quality from the sample stream instead of downloading acquisition_data.csv and running
+# analyze_locking_time afterwards. Every statistic is updated chunk by chunk at a constant cost per
+# sample, and the latest snapshot is served as JSON over HTTP.
+
+
+class RollingStats:
+    # Mean and RMS over the last `window` samples, O(1) per sample
+    def __init__(self, window):
+        self.window = window
+        self.buffer = np.zeros(window)
+        self.position = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self._since_refresh = 0
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if len(x) >= self.window:
+            self.buffer[:] = x[-self.window:]
+            self.position = 0
+            self.count = self.window
+            self.refresh()
+            return
+        indices = np.arange(self.position, self.position + len(x)) % self.window
+        old = self.buffer[indices]  # Zeros until the window has filled, so they drop out of the sums
+        self.sum += x.sum() - old.sum()
+        self.sum_sq += np.dot(x, x) - np.dot(old, old)
+        self.buffer[indices] = x
+        self.position = (self.position + len(x)) % self.window
+        self.count = min(self.window, self.count + len(x))
+        self._since_refresh += len(x)
+        if self._since_refresh > 100 * self.window:
+            self.refresh()  # Keep rounding errors of the running sums from accumulating
+
+    def refresh(self):
+        self.sum = self.buffer.sum()
+        self.sum_sq = np.dot(self.buffer, self.buffer)
+        self._since_refresh = 0
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else np.nan
+
+    @property
+    def rms(self):
+        return np.sqrt(max(self.sum_sq, 0.0) / self.count) if self.count else np.nan
+
+
+class LockTracker:
+    # Lock/unlock state with the same definition as signal_acquisition.analyze_locking_time: the loop is
+    # locked once the signal has stayed within lock_value +- lock_width for more than min_samples samples.
+    def __init__(self, lock_value=1756, lock_width=5, min_samples=200, history=100):
+        self.lock_value = lock_value
+        self.lock_width = lock_width
+        self.min_samples = min_samples
+        self.run_length = 0  # Samples in band so far in the current run
+        self.samples = 0
+        self.locked_samples = 0
+        self.lock_count = 0
+        self.unlock_count = 0
+        self.first_lock_sample = None
+        self.last_unlock_sample = None
+        self.lock_lengths = collections.deque(maxlen=history)  # Samples per finished lock
+
+    @property
+    def locked(self):
+        return self.run_length > self.min_samples
+
+    def update(self, x):
+        # Returns the sample indices where lock was lost in this chunk
+        x = np.asarray(x)
+        if len(x) == 0:
+            return []
+        start = self.samples
+        self.samples += len(x)
+        carry = self.run_length
+        was_locked = self.locked
+        in_band = (x > self.lock_value - self.lock_width) & (x < self.lock_value + self.lock_width)
+        edges = np.diff(np.concatenate([[carry > 0], in_band, [False]]).astype(np.int8))
+        run_starts = np.flatnonzero(edges == 1)
+        run_stops = np.flatnonzero(edges == -1)  # Exclusive, a run still open ends at len(x)
+        if carry:
+            run_starts = np.concatenate([[-carry], run_starts])  # Continues from the previous chunk
+        lengths = run_stops - run_starts
+        kept = lengths > self.min_samples
+        finished = kept.copy()
+        if in_band[-1]:
+            finished[-1] = False
+
+        self.lock_count += int(np.count_nonzero(kept)) - int(was_locked)
+        self.locked_samples += int(lengths[kept].sum()) - (carry if was_locked else 0)
+        if self.first_lock_sample is None and kept.any():
+            self.first_lock_sample = int(start + run_starts[np.argmax(kept)])
+        unlocks = (start + run_stops[finished]).tolist()
+        self.unlock_count += len(unlocks)
+        self.lock_lengths.extend(lengths[finished].tolist())
+        if unlocks:
+            self.last_unlock_sample = unlocks[-1]
+        self.run_length = int(lengths[-1]) if in_band[-1] else 0
+        return unlocks
+
+
+class BandPower:
+    # Power in a frequency band from an exponentially weighted Welch PSD, ewma ~ 1 / frames remembered
+    def __init__(self, samplerate, band, nfft=1024, ewma=1 / 16):
+        self.band = band
+        self.welch = spectral.StreamingWelch(samplerate, nfft, ewma=ewma)
+
+    def update(self, x):
+        self.welch.update(x)
+
+    @property
+    def power(self):
+        if self.welch.frames == 0:
+            return np.nan
+        return spectral.band_power(*self.welch.psd(), self.band)
+
+
+class LockMonitor:
+    def __init__(self, samplerate, lock_value=1756, lock_width=5, min_samples=200, window=8192, band=(1e3, 10e3),
+                 nfft=1024, on_unlock=None):
+        self.samplerate = samplerate
+        self.lock_value = lock_value
+        self.tracker = LockTracker(lock_value, lock_width, min_samples)
+        self.residual = RollingStats(window)  # Of signal - lock_value
+        self.band_power = BandPower(samplerate, band, nfft)
+        self.on_unlock = on_unlock  # Called with the stream time (s) of every loss of lock
+        self.lock = threading.Lock()
+        self.updated = None
+
+    def update(self, x):
+        x = np.asarray(x)
+        with self.lock:
+            unlocks = self.tracker.update(x)
+            self.residual.update(x - self.lock_value)
+            self.band_power.update(x)
+            self.updated = time.time()
+        if self.on_unlock is not None:
+            for sample in unlocks:
+                self.on_unlock(sample / self.samplerate)
+
+    def run(self, chunks):
+        for chunk in chunks:
+            self.update(chunk)
+
+    def snapshot(self):
+        with self.lock:
+            tracker = self.tracker
+            lock_lengths = np.array(tracker.lock_lengths) / self.samplerate
+            return {
+                "time": tracker.samples / self.samplerate,
+                "updated": self.updated,
+                "locked": tracker.locked,
+                "current_lock_time": tracker.run_length / self.samplerate if tracker.locked else 0.0,
+                "lock_count": tracker.lock_count,
+                "unlock_count": tracker.unlock_count,
+                "last_unlock_time": None if tracker.last_unlock_sample is None
+                else tracker.last_unlock_sample / self.samplerate,
+                "time_to_first_lock": None if tracker.first_lock_sample is None
+                else tracker.first_lock_sample / self.samplerate,
+                "locked_fraction": tracker.locked_samples / tracker.samples if tracker.samples else None,
+                "mean_lock_time": float(np.mean(lock_lengths)) if len(lock_lengths) else None,
+                "residual_mean": float(self.residual.mean),
+                "residual_rms": float(self.residual.rms),
+                "band": list(self.band_power.band),
+                "band_power": self.band_power.power,
+            }
+
+
+def serve_status(monitor, host="127.0.0.1", port=8080):
+    # GET / or /status returns monitor.snapshot() as JSON. Runs on a daemon thread, returns the server.
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/status"):
+                self.send_error(404)
+                return
+            body = json.dumps(monitor.snapshot(), default=float).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # One line per poll would drown everything else
+
+    server = ThreadingHTTPServer((host, port), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stream_chunks(receiver, channel=0, chunk_size=1024):
+    # One channel of the streaming server in small blocks, so a loss of lock shows up within a block
+    for chunk in receiver.iter_chunks(chunk_size=chunk_size):
+        yield chunk[:, channel]
+
+
+def acquirer_chunks(acquirer, num_buffers=None):
+    # On the board, e.g. with RedPitayaPid.acquisition.Acquirer after configure(). Consecutive buffers
+    # are separate acquisitions, so samples between them are not seen.
+    for buffer in acquirer.iter_buffers(num_buffers):
+        yield buffer.copy()
+
+
+def open_acquirer(channel=0, buffer_size=1024, decimation=64):
+    # RedPitayaPid.acquisition.Acquirer triggering immediately on every buffer, imported here because it
+    # needs the board's rp module (or RP_FAKE=1)
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "RedPitayaPid")
+    if directory not in sys.path:
+        sys.path.append(directory)
+    from acquisition import rp, Acquirer
+    acquirer = Acquirer(buffer_size, rp.RP_CH_2 if channel else rp.RP_CH_1)
+    acquirer.configure(decimation=getattr(rp, f"RP_DEC_{decimation}"), trigger_source=rp.RP_TRIG_SRC_NOW)
+    return acquirer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monitor lock quality from the Red Pitaya stream")
+    parser.add_argument("--ip", default="127.0.0.1", help="Red Pitaya running the streaming server")
+    parser.add_argument("--stream-port", type=int, default=8900)
+    parser.add_argument("--channel", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--lock-value", type=float, default=1756)
+    parser.add_argument("--lock-width", type=float, default=5)
+    parser.add_argument("--min-samples", type=int, default=200)
+    parser.add_argument("--band", type=float, nargs=2, default=[1e3, 10e3], metavar=("LOW", "HIGH"))
+    parser.add_argument("--host", default="127.0.0.1", help="Address the HTTP endpoint listens on")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--decimation", type=int, default=64, help="ADC decimation factor for --acquisition")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--acquisition", action="store_true",
+                        help="Run on the board and read the ADC buffers directly, --chunk-size samples each")
+    source.add_argument("--fake", action="store_true", help="Monitor a local fake streaming server")
+    source.add_argument("--experimental-native", action="store_true",
+                        help="Read a board's streaming server in-process, the stream format is only tested against "
+                             "the fake server so far")
+    args = parser.parse_args()
+
+    if args.acquisition:
+        with open_acquirer(args.channel, args.chunk_size, args.decimation) as acquirer:
+            monitor = LockMonitor(acquirer.samplerate, args.lock_value, args.lock_width, args.min_samples,
+                                  band=tuple(args.band),
+                                  on_unlock=lambda t: print(f"Lost lock at {t:.6f} s"))
+            server = serve_status(monitor, args.host, args.port)
+            print(f"Serving lock status on http://{args.host}:{server.server_address[1]}/status")
+            monitor.run(acquirer_chunks(acquirer))
+        return
+
+    fake = None
+    if args.fake:
+        fake = FakeStreamingServer(realtime=True)
+        fake.start()
+        args.ip, args.stream_port = fake.host, fake.port
+    try:
+        with StreamReceiver(args.ip, args.stream_port, allow_unverified=True) as receiver:
+            chunks = stream_chunks(receiver, args.channel, args.chunk_size)
+            first = next(chunks)  # The sample rate is only known once data arrives
+            monitor = LockMonitor(receiver.samplerate, args.lock_value, args.lock_width, args.min_samples,
+                                  band=tuple(args.band),
+                                  on_unlock=lambda t: print(f"Lost lock at {t:.6f} s"))
+            monitor.update(first)
+            server = serve_status(monitor, args.host, args.port)
+            print(f"Serving lock status on http://{args.host}:{server.server_address[1]}/status")
+            monitor.run(chunks)
+    finally:
+        if fake is not None:
+            fake.stop()
+
+
+if __name__ == "__main__":
+    main()
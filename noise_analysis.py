@@ -1,13 +1,13 @@
 import numpy as np
-import pandas as pd
+from csv_loader import load_csv
 import matplotlib.pyplot as plt
-from scipy.signal import welch
+import spectral
 
 # Load the data
 def load_signal(filename):
-    data = pd.read_csv(filename)
-    time = data.iloc[:, 0].values  # First column is time
-    signal = data.iloc[:, 1].values  # Second column is sample (voltage)
+    data = load_csv(filename, header=True)  # Parsed once, later runs memory-map the .npy sidecar
+    time = data[:, 0]  # First column is time
+    signal = data[:, 1]  # Second column is sample (voltage)
     return time, signal
 
 # Compute the sampling rate
@@ -23,14 +23,14 @@ def plot_signals_and_psds(no_stable_file, stable_file):
     fs_ns = compute_sampling_rate(time_ns)
     fs_s = compute_sampling_rate(time_s)
 
-    f_ns, Pxx_ns = welch(signal_ns, fs=fs_ns, nperseg=1024)
-    f_s, Pxx_s = welch(signal_s, fs=fs_s, nperseg=1024)
+    f_ns, Pxx_ns = spectral.welch(signal_ns, fs_ns, nperseg=1024)
+    f_s, Pxx_s = spectral.welch(signal_s, fs_s, nperseg=1024)
     #f_ns, Pxx_ns = np.fft.fft(signal_ns, fs=fs_ns, nperseg=1024)
     #f_ns = fft_freqs = np.fft.fftfreq(len(signal_ns), d=1024)
 
     #f_s, Pxx_s = np.fft.fft(signal_s, fs=fs_s, nperseg=1024)
 
-    psd_ratio = (Pxx_s/np.mean(Pxx_s)) / (Pxx_ns/np.mean(Pxx_ns))
+    psd_ratio = spectral.psd_ratio(Pxx_s, Pxx_ns)
 
     plt.figure(figsize=(10, 4))
     plt.plot(time_ns, signal_ns, label="Unstabilized", color='red', alpha=0.7)
@@ -49,8 +49,11 @@ def plot_signals_and_psds(no_stable_file, stable_file):
     plt.grid(True)
 
     plt.figure(figsize=(10, 6))
-    plt.loglog(f_ns, Pxx_ns/np.mean(Pxx_ns), label="Unstabilized", linewidth=2, alpha=0.7, color='red')
-    plt.loglog(f_s, Pxx_s/np.mean(Pxx_s), label="Stabilized", linewidth=2, alpha=0.7, color='blue')
+    # Averaged into log spaced bins so the decades are evenly resolved on the log axis
+    plt.loglog(*spectral.log_bin(f_ns, Pxx_ns/np.mean(Pxx_ns)), label="Unstabilized", linewidth=2, alpha=0.7,
+               color='red')
+    plt.loglog(*spectral.log_bin(f_s, Pxx_s/np.mean(Pxx_s)), label="Stabilized", linewidth=2, alpha=0.7,
+               color='blue')
 
     plt.xlabel("Frequency (Hz)")
     plt.ylabel("Power Spectral Density (V²/Hz)")
@@ -59,7 +62,7 @@ def plot_signals_and_psds(no_stable_file, stable_file):
     plt.grid(True, which="both", linestyle="--", alpha=0.5)
 
     plt.figure(figsize=(10, 4))
-    plt.semilogx(f_ns, psd_ratio, label="PSD Ratio (Stabilized / Unstabilized)", color='black', linewidth=2)
+    plt.semilogx(*spectral.log_bin(f_ns, psd_ratio), label="PSD Ratio (Stabilized / Unstabilized)", color='black', linewidth=2)
     plt.axhline(1, color='gray', linestyle="--", alpha=0.7)  # Reference line at 1
     plt.xlabel("Frequency (Hz)")
     plt.ylabel("PSD Ratio")
@@ -1,6 +1,6 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.signal import welch
+import spectral
 from remote_pid import RP_Pid
 from remote_streaming import RP_Streamer
 
@@ -38,32 +38,24 @@ def plot_pid_comparison(data_unstable, data_stable, samplerate):
     plt.legend()
     plt.grid(True)
 
-    N = len(channel_1_unstable)
-    f_unstable = np.fft.fftfreq(N, d=1 / samplerate)[:N // 2]
-    Pxx_unstable = (np.abs(np.fft.fft(channel_1_unstable)) ** 2) / N
-    Pxx_unstable = Pxx_unstable[:N // 2]  # Keep only positive frequencies
-   # Pxx_unstable = Pxx_unstable / np.mean(Pxx_unstable)
-
-    N = len(channel_1_stable)
-    f_stable = np.fft.fftfreq(N, d=1 / samplerate)[:N // 2]
-    Pxx_stable = (np.abs(np.fft.fft(channel_1_stable)) ** 2) / N
-    Pxx_stable = Pxx_stable[:N // 2]  # Keep only positive frequencies
-    #Pxx_stable = Pxx_stable / np.mean(Pxx_stable)
+    f_unstable, Pxx_unstable = spectral.fft_power(channel_1_unstable, samplerate)
+    f_stable, Pxx_stable = spectral.fft_power(channel_1_stable, samplerate)
 
+    # The full resolution spectra have one point per 1/T Hz, they are averaged into log spaced bins for plotting
     plt.figure(figsize=(10, 6))
-    plt.loglog(f_unstable, Pxx_unstable, label="Unstabilized", linewidth=2, alpha=0.7,
+    plt.loglog(*spectral.log_bin(f_unstable, Pxx_unstable), label="Unstabilized", linewidth=2, alpha=0.7,
                color='red')
-    plt.loglog(f_stable, Pxx_stable, label="Stabilized", linewidth=2, alpha=0.7, color='blue')
+    plt.loglog(*spectral.log_bin(f_stable, Pxx_stable), label="Stabilized", linewidth=2, alpha=0.7, color='blue')
     plt.xlabel("Frequency (Hz)")
     plt.ylabel("Amplitude")
     plt.title("FFT: Stabilized vs. Unstabilized")
     plt.legend()
     plt.grid(True, which="both", linestyle="--", alpha=0.5)
 
-    psd_ratio = (Pxx_stable / np.mean(Pxx_stable)) / (Pxx_unstable / np.mean(Pxx_unstable))
+    psd_ratio = spectral.psd_ratio(Pxx_stable, Pxx_unstable)
 
     plt.figure(figsize=(10, 4))
-    plt.loglog(f_unstable, psd_ratio, label="FFT Ratio (Stabilized / Unstabilized)", color='black', linewidth=2)
+    plt.loglog(*spectral.log_bin(f_unstable, psd_ratio), label="FFT Ratio (Stabilized / Unstabilized)", color='black', linewidth=2)
     plt.axhline(1, color='gray', linestyle="--", alpha=0.7)  # Reference line at 1
     plt.xlabel("Frequency (Hz)")
     plt.ylabel("FFT Ratio")
@@ -71,11 +63,16 @@ def plot_pid_comparison(data_unstable, data_stable, samplerate):
     plt.legend()
     plt.grid(True, which="both", linestyle="--", alpha=0.5)
 
-    f_unstable, Pxx_unstable_welch = welch(channel_1_unstable, fs=samplerate, nperseg=1024)
-    f_stable, Pxx_stable_welch = welch(channel_1_stable, fs=samplerate, nperseg=1024)
+    f_unstable, Pxx_unstable_welch = spectral.welch(channel_1_unstable, samplerate, nperseg=1024)
+    f_stable, Pxx_stable_welch = spectral.welch(channel_1_stable, samplerate, nperseg=1024)
+    decades = range(int(np.ceil(np.log10(f_stable[1]))), int(np.floor(np.log10(samplerate / 2))))
+    bands = [(10 ** k, 10 ** (k + 1)) for k in decades]
+    for band, db in zip(bands, spectral.suppression_db(f_stable, Pxx_stable_welch, Pxx_unstable_welch, bands)):
+        print(f"Noise suppression {band[0]:g}-{band[1]:g} Hz: {db:.1f} dB")
     plt.figure(figsize=(10,4))
-    plt.loglog(f_unstable, Pxx_unstable_welch, label="Unstabilized", linewidth=2, alpha=0.7, color="red")
-    plt.loglog(f_stable, Pxx_stable_welch, label="Stabilized", linewidth=2, alpha=0.7, color="blue")
+    plt.loglog(*spectral.log_bin(f_unstable, Pxx_unstable_welch), label="Unstabilized", linewidth=2, alpha=0.7,
+               color="red")
+    plt.loglog(*spectral.log_bin(f_stable, Pxx_stable_welch), label="Stabilized", linewidth=2, alpha=0.7, color="blue")
     plt.xlabel("Frequency (Hz)")
     plt.ylabel("Power Spectral Density (V²/Hz)")
     plt.title("Power Spectral Density Comparison: Stabilized vs. Unstabilized")
@@ -93,8 +90,7 @@ pid = RP_Pid(pid_pitaya_ip)
 pid.clear_pid()
 data_unstable, samplerate = streamer.capture_signal(captures)
 set_point = 800
-pid.set_pid(11,8000, 500, 0, set_point)
-pid.set_pid(21,500, 0, 0, set_point)
+pid.set_pids({11: (8000, 500, 0, set_point), 21: (500, 0, 0, set_point)})
 data_stable, _samplerate = streamer.capture_signal(captures)
 print(f"sample rate {samplerate}")
 plot_pid_comparison(data_unstable, data_stable, samplerate)
@@ -1,5 +1,9 @@
 from remote_streaming import RP_Streamer
 from remote_pid import RP_Pid
+from evaluation_pipeline import PipelinedEvaluator
+from settling import settled_capture, SettlingDetector
+from fitness import make_fitness
+from surrogate_optimize import SurrogateOptimizer
 import numpy as np
 import pygad
 import matplotlib.pyplot as plt
@@ -10,60 +14,61 @@ pid_pitaya_ip = "rp-f0cace.local"
 capture_pitaya_ip = "10.120.12.200"
 captures = 1000000
 setpoint = 800# Configurable setpoint
+# Stream after each gain change, skip the transient and stop once the fitness is pinned down
+# (or clearly worse than the median so far) instead of always taking `captures` samples.
+# rpsa_client still records all `captures` samples, only the scoring stops early.
+settling_capture = False
+chunk_size = 65536
+# Score for a candidate, a fitness.PRESETS name or a {metric: weight} dict. "distance" is the original
+# squared distance to the setpoint plus squared slope, "band_noise" integrates the noise over fitness_band (Hz).
+fitness_name = "distance"
+fitness_band = (10, 1000)
+fitness_channel = None  # Column of two-channel captures to score, None scores both like the original fitness
 
 # Create log directory
 log_dir = "pid_optimization_log"
-os.makedirs(log_dir, exist_ok=True)
 log_file = os.path.join(log_dir, "fitness_log.txt")
 
-# Initialize the streamer and PID controller
-streamer = RP_Streamer(capture_pitaya_ip)
-pid = RP_Pid(pid_pitaya_ip)
-pid.clear_pid()
 
-# Capture initial unstable signal
-# data_unstable, samplerate = streamer.capture_signal(captures)
+compute_fitness = make_fitness(fitness_name, setpoint=setpoint / 8192, band=fitness_band, lock_width=5 / 8192,
+                               tolerance=5 / 8192, channel=fitness_channel)
 
-# List to store fitness values
-fitness_history = []
 
+def capture_settled(streamer, fitness_history):
+    # Per-chunk fitness scaled to the fixed-length score so both modes rank candidates the same way
+    def chunk_fitness(chunk):
+        return compute_fitness(chunk, streamer.samplerate, length=captures)
 
-def fitness_func(ga_instance, solution, solution_idx):
+    reject_below = np.median(fitness_history) if len(fitness_history) >= sol_per_pop else None
+    # Settled once the scored channel is, the first one when both are scored
+    detector = SettlingDetector(channel=fitness_channel or 0)
+    chunks = streamer.iter_chunks(captures, chunk_size, "float32")
+    try:
+        result = settled_capture(chunks, chunk_fitness, max_samples=captures, reject_below=reject_below,
+                                 detector=detector)
+    finally:
+        chunks.close()
+    print(result)
+    return result.data, streamer.samplerate, result.fitness
+
+
+def solution_gains(solution):
     #kp11, ki11, kd11, kp21, ki21, kd21  = map(lambda x: int(x), solution) # Extract parameters
     kp11, ki11, kd11, kp21, ki21, kd21  = solution # Extract parameters
-    pid.set_pid(11, kp11, ki11, kd11, setpoint)
-    pid.set_pid(21, kp21, ki21, kd21, setpoint)
-    data_stable, rate = streamer.capture_signal(captures)
-    distance = (data_stable - (setpoint / 8192)) ** 2
-    derivative = (data_stable[1:] - data_stable[0:-1])**2
-    fitness = -1*(np.sum(distance) + np.sum(derivative))
-    plt.figure(figsize=(8, 6))
-    time = [i/rate for i in range(len(data_stable))]
-    plt.plot(time, data_stable)
-    plt.xlabel("Time")
-    plt.ylabel("Signal")
-    plt.title(f"Generation={ga_instance.generations_completed}, Solution Index={solution_idx}, Fitness={fitness}")
-    plt.ylim(0, 1)
-    plt.grid()
-    path = log_dir + f"/Generation_{ga_instance.generations_completed}"
-    os.makedirs(path, exist_ok=True)
-    filename = f"Idx_{solution_idx}.png"
-    plt.savefig(f"{path}/{filename}")
-    plt.close()
-    print("-----------------------------------------")
-    log_entry = f"Generation: {ga_instance.generations_completed}, Solution Index: {solution_idx}\n   PID11: ({kp11}, {ki11}, {kd11})\n   PID21: ({kp21}, {ki21}, {kd21})\n   Fitness: {fitness:.6f}\n"
-    print(log_entry)
+    return {11: (kp11, ki11, kd11, setpoint), 21: (kp21, ki21, kd21, setpoint)}
 
-    fitness_history.append(fitness)
-    plt.plot(fitness_history)
-    plt.savefig(f"{log_dir}/fitness.png")
-    plt.close()
-    with open(log_file, "a") as f:
-        f.write(log_entry)
 
-    return fitness
+def describe_solution(solution):
+    kp11, ki11, kd11, kp21, ki21, kd21 = solution
+    return f"   PID11: ({kp11}, {ki11}, {kd11})\n   PID21: ({kp21}, {ki21}, {kd21})\n"
 
 
+# "genetic" runs pygad, "surrogate" a Gaussian-process model with expected improvement, which usually
+# gets to a comparable fitness in a fraction of the captures
+optimizer = "genetic"
+surrogate_evaluations = 75
+surrogate_batch_size = 5  # Candidates proposed at once, captured back to back through the pipeline
+
 num_generations = 25
 num_parents_mating = 6
 sol_per_pop = 15  # Total population size
@@ -87,54 +92,111 @@ manual_solutions = np.array([
     [-4000, -500, 0, 2000, 0, 0],
     [7000, 1000, 150, 3000, 0, 00]])
 
-# Generate the rest of the population randomly within specified ranges
-num_random_solutions = sol_per_pop - manual_solutions.shape[0]
-random_solutions = np.array([
-    np.random.uniform(low=param_ranges[i, 0], high=param_ranges[i, 1], size=num_random_solutions)
-    for i in range(num_genes)
-]).T
-
-initial_population = np.vstack((manual_solutions, random_solutions))
-
-ga_instance = pygad.GA(
-    num_generations=num_generations,
-    num_parents_mating=num_parents_mating,
-    fitness_func=fitness_func,
-    sol_per_pop=sol_per_pop,
-    num_genes=num_genes,
-    gene_type=int,
-    initial_population=initial_population,  # Custom initial population
-    parent_selection_type="sss",
-    keep_elitism=3,
-    crossover_type="single_point",
-    mutation_type="random",
-    random_mutation_max_val=250,
-    random_mutation_min_val=-250,
-    mutation_probability=0.3
-)
-
-# Run the GA
-ga_instance.run()
-
-# Retrieve best solution
-solution, solution_fitness, solution_idx = ga_instance.best_solution()
-print(f"Best PID parameters: {solution}")
-print(f"Best fitness value: {solution_fitness}")
-
-# Apply best solution to the PID controller
-pid.set_pid(*solution, setpoint)
-data_stable, _ = streamer.capture_signal(captures)
-
-plt.figure()
-plt.plot(fitness_history, marker='o', linestyle='-')
-plt.xlabel("Trial")
-plt.ylabel("Fitness Value")
-plt.title("Fitness Evolution Over Trials")
-plt.grid()
-
-plot_path = os.path.join(log_dir, "fitness_plot.png")
-plt.savefig(plot_path)
-plt.show()
-
-print(f"Log saved to: {log_file}")
-print(f"Plot saved to: {plot_path}")
\ No newline at end of file
+
+def run_genetic(evaluator):
+    # pygad hands over a whole population at once so candidates can be pipelined
+    def fitness_func(ga_instance, solutions, solution_indices):
+        return evaluator.evaluate_batch(solutions, solution_indices, ga_instance.generations_completed)
+
+    # Generate the rest of the population randomly within specified ranges
+    num_random_solutions = sol_per_pop - manual_solutions.shape[0]
+    random_solutions = np.array([
+        np.random.uniform(low=param_ranges[i, 0], high=param_ranges[i, 1], size=num_random_solutions)
+        for i in range(num_genes)
+    ]).T
+
+    initial_population = np.vstack((manual_solutions, random_solutions))
+
+    ga_instance = pygad.GA(
+        num_generations=num_generations,
+        num_parents_mating=num_parents_mating,
+        fitness_func=fitness_func,
+        fitness_batch_size=sol_per_pop,
+        sol_per_pop=sol_per_pop,
+        num_genes=num_genes,
+        gene_type=int,
+        initial_population=initial_population,  # Custom initial population
+        parent_selection_type="sss",
+        keep_elitism=3,
+        crossover_type="single_point",
+        mutation_type="random",
+        random_mutation_max_val=250,
+        random_mutation_min_val=-250,
+        mutation_probability=0.3
+    )
+
+    ga_instance.run()
+    solution, solution_fitness, solution_idx = ga_instance.best_solution(ga_instance.last_generation_fitness)
+    return solution, solution_fitness
+
+
+def run_surrogate(evaluator):
+    # Batches go through the same pipelined evaluator, the batch index takes the place of the generation
+    surrogate = SurrogateOptimizer(param_ranges, initial_points=manual_solutions, integer=True)
+
+    def evaluate_batch(solutions):
+        batch = len(surrogate.y) // surrogate_batch_size
+        return evaluator.evaluate_batch(solutions, range(len(solutions)), batch)
+
+    solution, solution_fitness = surrogate.run(evaluate_batch, surrogate_evaluations, surrogate_batch_size)
+    return solution.astype(int), solution_fitness
+
+
+def main():
+    os.makedirs(log_dir, exist_ok=True)
+
+    # Initialize the streamer and PID controller
+    streamer = RP_Streamer(capture_pitaya_ip)
+    pid = RP_Pid(pid_pitaya_ip)
+    pid.connect()  # Keep one WebSocket session open for the whole run
+    pid.clear_pid()
+
+    # Capture initial unstable signal
+    # data_unstable, samplerate = streamer.capture_signal(captures)
+
+    # Hardware work (gains + capture) stays on this thread, scoring, plots and logs run behind it
+    if settling_capture:
+        capture = lambda: capture_settled(streamer, evaluator.fitness_history)
+    else:
+        capture = lambda: streamer.capture_signal(captures)
+    evaluator = PipelinedEvaluator(
+        apply_solution=lambda solution: pid.set_pids(solution_gains(solution)),
+        capture=capture,
+        fitness=compute_fitness,
+        describe=describe_solution,
+        log_dir=log_dir,
+        log_file=log_file,
+    )
+
+    with evaluator:
+        if optimizer == "surrogate":
+            solution, solution_fitness = run_surrogate(evaluator)
+        else:
+            solution, solution_fitness = run_genetic(evaluator)
+    fitness_history = evaluator.fitness_history
+    print(f"Best PID parameters: {solution}")
+    print(f"Best fitness value: {solution_fitness}")
+
+    # Apply best solution to the PID controller
+    pid.set_pids(solution_gains(solution))
+    data_stable, _ = streamer.capture_signal(captures)
+    print(f"PID command latency: {pid.latency_stats()}")
+    pid.disconnect()
+
+    plt.figure()
+    plt.plot(fitness_history, marker='o', linestyle='-')
+    plt.xlabel("Trial")
+    plt.ylabel("Fitness Value")
+    plt.title("Fitness Evolution Over Trials")
+    plt.grid()
+
+    plot_path = os.path.join(log_dir, "fitness_plot.png")
+    plt.savefig(plot_path)
+    plt.show()
+
+    print(f"Log saved to: {log_file}")
+    print(f"Plot saved to: {plot_path}")
+
+
+if __name__ == "__main__":
+    main()
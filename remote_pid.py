@@ -1,26 +1,239 @@
 import asyncio
+import collections
+import itertools
+import json
+import threading
+import time
 import websockets
 
+
+class RP_PidSession:
+    # Long-lived WebSocket connection to server.py. Requests are tagged with an id so several
+    # commands can be in flight at once, and the round-trip time of every command is recorded.
+    def __init__(self, ws_url, reconnect_attempts=3, timeout=5.0, latency_history=1000):
+        self.ws_url = ws_url
+        self.reconnect_attempts = reconnect_attempts
+        self.timeout = timeout
+        self.latencies = collections.deque(maxlen=latency_history)  # (message, seconds)
+        self.last_latency = None
+        self._websocket = None
+        self._reader_task = None
+        self._pending = {}
+        self._ids = itertools.count(1)
+        self._connect_lock = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def connected(self):
+        return self._websocket is not None and self._reader_task is not None and not self._reader_task.done()
+
+    async def connect(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.connected:
+                return
+            self._websocket = await websockets.connect(self.ws_url)
+            self._pending = {}
+            self._reader_task = asyncio.create_task(self._read_responses(self._websocket, self._pending))
+
+    async def close(self):
+        websocket, self._websocket = self._websocket, None
+        if websocket is not None:
+            await websocket.close()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+
+    async def _read_responses(self, websocket, pending):
+        try:
+            async for raw in websocket:
+                response = json.loads(raw)
+                future = pending.pop(response.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            # Anything still waiting on this connection has to be resent after a reconnect
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("WebSocket connection closed"))
+            pending.clear()
+
+    async def request(self, message):
+        last_error = None
+        for _ in range(self.reconnect_attempts + 1):
+            websocket, pending, request_id = None, {}, None
+            try:
+                await self.connect()
+                websocket, pending = self._websocket, self._pending
+                request_id = next(self._ids)
+                future = asyncio.get_running_loop().create_future()
+                pending[request_id] = future
+                start = time.perf_counter()
+                await websocket.send(json.dumps({"id": request_id, **message}))
+                response = await asyncio.wait_for(future, self.timeout)
+                self.last_latency = time.perf_counter() - start
+                self.latencies.append((message, self.last_latency))
+                return response
+            except (OSError, ConnectionError, websockets.exceptions.ConnectionClosed) as e:
+                last_error = e
+                pending.pop(request_id, None)
+                # Only tear down the connection this request used; another request may already have reconnected
+                if websocket is not None and websocket is self._websocket:
+                    await self.close()
+        raise ConnectionError(f"Gave up after {self.reconnect_attempts + 1} attempts: {last_error}")
+
+    async def request_many(self, messages):
+        # Pipelined: every message is sent before any response is awaited
+        return await asyncio.gather(*(self.request(message) for message in messages))
+
+    def latency_stats(self):
+        if not self.latencies:
+            return None
+        seconds = sorted(latency for _, latency in self.latencies)
+        return {
+            "count": len(seconds),
+            "mean": sum(seconds) / len(seconds),
+            "median": seconds[len(seconds) // 2],
+            "max": seconds[-1],
+        }
+
+
 class RP_Pid:
     def __init__(self, ip):
         self.ws_url = f"ws://{ip}:8765"  # WebSocket server URL
-        self.pid_executable = "/root/PhaseStabilization/RedPitayaPid/pid"
-        self.clear_executable = "/root/PhaseStabilization/RedPitayaPid/clear_pid"
+        self.session = None
+        self._loop = None
+        self._loop_thread = None
+
+    # Persistent mode, synchronous: `with RP_Pid(ip) as pid:` (or connect()/disconnect()) keeps one
+    # connection open on a background event loop and every set_pid/clear_pid call reuses it.
+    def __enter__(self):
+        return self.connect()
 
-    async def send_command(self, command):
+    def __exit__(self, exc_type, exc, tb):
+        self.disconnect()
+
+    def connect(self):
+        if self._loop is not None:
+            return self  # Already connected, keep the running loop and session
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
         try:
-            async with websockets.connect(self.ws_url) as websocket:
-                await websocket.send(command)  # Send the command
-                response = await websocket.recv()  # Receive output
-                return response
+            self._run(self.open_session())
+        except Exception:
+            self._stop_loop()
+            raise
+        return self
+
+    def disconnect(self):
+        if self._loop is None:
+            return
+        try:
+            self._run(self.close_session())
+        finally:
+            self._stop_loop()
+
+    def _stop_loop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self._loop = None
+        self._loop_thread = None
+
+    # Persistent mode, asynchronous: `async with RP_Pid(ip) as pid:` then await the *_async methods
+    async def __aenter__(self):
+        await self.open_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close_session()
+
+    async def open_session(self):
+        self.session = RP_PidSession(self.ws_url)
+        await self.session.connect()
+
+    async def close_session(self):
+        session, self.session = self.session, None
+        if session is not None:
+            await session.close()
+
+    def _run(self, coroutine):
+        if self._loop is not None:
+            return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+        return asyncio.run(coroutine)
+
+    async def send_request(self, message):
+        try:
+            if self.session is not None:
+                response = await self.session.request(message)
+            else:
+                async with websockets.connect(self.ws_url) as websocket:
+                    await websocket.send(json.dumps({"id": 0, **message}))  # Send the request
+                    response = json.loads(await websocket.recv())  # Receive the reply
         except Exception as e:
             print(f"WebSocket Error: {e}")
             return None
+        if not response.get("ok"):
+            print(f"PID Error: {response.get('error')}")
+            return None
+        return response.get("result")
+
+    @staticmethod
+    def pid_request(channel, p, i, d, set_point):
+        return {"op": "set_pid", "channel": int(channel), "kp": int(p), "ki": int(i), "kd": int(d),
+                "setpoint": int(set_point)}
+
+    async def set_pid_async(self, channel, p, i, d, set_point):
+        return await self.send_request(self.pid_request(channel, p, i, d, set_point))
+
+    @staticmethod
+    def pids_request(gains):
+        # gains maps channel -> (p, i, d, set_point) for any subset of 11, 12, 21 and 22
+        return {"op": "set_pids", "pids": {
+            str(int(channel)): {"kp": int(p), "ki": int(i), "kd": int(d), "setpoint": int(set_point)}
+            for channel, (p, i, d, set_point) in gains.items()
+        }}
+
+    async def set_pids_async(self, gains):
+        return await self.send_request(self.pids_request(gains))
+
+    async def clear_pid_async(self):
+        return await self.send_request({"op": "clear_pid"})
+
+    async def read_pid_async(self, channel):
+        return await self.send_request({"op": "read_pid", "channel": int(channel)})
+
+    async def batch_async(self, requests):
+        return await self.send_request({"op": "batch", "requests": list(requests)})
 
     def set_pid(self, channel, p, i, d, set_point):
-        cmd = f"{self.pid_executable} {channel} {p} {i} {d} {set_point}"
-        asyncio.run(self.send_command(cmd))
+        self._run(self.set_pid_async(channel, p, i, d, set_point))
+
+    def set_pids(self, gains):
+        self._run(self.set_pids_async(gains))
 
     def clear_pid(self):
-        cmd = self.clear_executable
-        asyncio.run(self.send_command(cmd))
+        self._run(self.clear_pid_async())
+
+    def read_pid(self, channel):
+        return self._run(self.read_pid_async(channel))
+
+    def batch(self, requests):
+        return self._run(self.batch_async(requests))
+
+    @property
+    def last_latency(self):
+        return None if self.session is None else self.session.last_latency
+
+    def latency_stats(self):
+        return None if self.session is None else self.session.latency_stats()
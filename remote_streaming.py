@@ -1,3 +1,4 @@
+import asyncio
 import os
 import glob
 import subprocess
@@ -5,20 +6,114 @@ import soundfile as sf
 import json
 import time
 import requests
+import threading
+from stream_receiver import StreamReceiver
+import spectral
 class RP_Streamer():
-    def __init__(self, rp_ip, data_format="wav", port=8900, mode="raw", save_directory="./Dump"):
+    def __init__(self, rp_ip, data_format="wav", port=8900, mode="raw", save_directory="./Dump",
+                 experimental_native=False):
         self.red_pitaya_ip = rp_ip # Replace with your Red Pitaya's IP
         self.port = port# Port for streaming
         self.data_format = data_format # Format of the data (WAV file)
         self.mode = mode  # Data mode: 'raw' or 'volt'
         self.save_directory = save_directory  # Directory where WAV files are stored
         self.rpsa_client_path = "rpsa_client-2.00-35-aff683518/rpsa_client"
+        # EXPERIMENTAL: experimental_native=True receives samples over TCP in-process instead of going through
+        # rpsa_client and a WAV file. Its packet format is only tested against stream_receiver.FakeStreamingServer,
+        # not the board's streaming server (see stream_receiver.py), so nothing in the repo turns it on.
+        # Everything below also works through rpsa_client.
+        self.native = experimental_native
+        self.receiver = StreamReceiver(rp_ip, port, allow_unverified=True) if experimental_native else None
+        self.last_capture_samplerate = None
         # Clear storage directory
         files = glob.glob(os.path.join(self.save_directory, "*.*"))
         for file in files:
             os.remove(file)
 
+    def capture_raw(self, samples):
+        # int16 frames of shape (samples, channels) straight from the streaming server.
+        # A fresh connection per capture so no samples from before the call are returned.
+        with self.receiver:
+            data, samplerate = self.receiver.receive(samples)
+        if self.receiver.lost_samples:
+            print(f"Streaming server reported {self.receiver.lost_samples} lost samples")
+        return data, samplerate
+
+    def iter_chunks(self, samples=None, chunk_size=65536, dtype="int16"):
+        # Fixed size (chunk_size, channels) blocks of int16 or float32. Through rpsa_client the capture is
+        # taken first and its WAV read back block by block, so memory stays at one chunk either way. The
+        # experimental native receiver yields them as they arrive, and only it can stream with samples=None.
+        if self.native:
+            with self.receiver:
+                yield from self.receiver.iter_chunks(samples, chunk_size, dtype)
+            return
+        if samples is None:
+            raise ValueError("Streaming without a sample limit needs the experimental native receiver")
+        if not self.run_rpsa_client(samples):
+            raise RuntimeError("rpsa_client capture failed")
+        self.last_capture_path = self.newest_capture()
+        self.last_capture_samplerate = sf.info(self.last_capture_path).samplerate
+        yield from sf.blocks(self.last_capture_path, blocksize=chunk_size, dtype=dtype, always_2d=True)
+
+    @property
+    def samplerate(self):
+        # Of the current or last capture
+        return self.receiver.samplerate if self.native else self.last_capture_samplerate
+
+    async def aiter_chunks(self, samples=None, chunk_size=65536, dtype="int16", max_pending=4):
+        # Async version of iter_chunks. Chunks are read on a worker thread which stalls once
+        # max_pending chunks are waiting, so backpressure reaches the server the same way.
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=max_pending)
+        stop = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for chunk in self.iter_chunks(samples, chunk_size, dtype):
+                    if stop.is_set():
+                        return
+                    asyncio.run_coroutine_threadsafe(queue.put(chunk), loop).result()
+                item = done
+            except Exception as e:
+                item = e
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        producer = loop.run_in_executor(None, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            while not producer.done():
+                # Unblock a producer waiting on a full queue
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.01)
+
     def capture_signal(self, samples):
+        if self.native:
+            try:
+                data, samplerate = self.capture_raw(samples)
+                # Same scaling and shape soundfile gives for the 16 bit WAV captures
+                data = data.astype("float32") / 32768
+                if data.shape[1] == 1:
+                    data = data[:, 0]
+                self.last_capture_data, self.last_capture_samplerate = data, samplerate
+                return self.last_capture_data, self.last_capture_samplerate
+            except Exception as e:
+                print(f"Error during data capture or processing: {e}")
+                return None
+        if self.run_rpsa_client(samples):
+            return self.get_last_capture_data()
+
+    def run_rpsa_client(self, samples):
+        # Captures `samples` samples to a new WAV file in save_directory, False on failure
         try:
             with subprocess.Popen(
                 [
@@ -39,16 +134,54 @@ class RP_Streamer():
                 #print(f"Capturing {samples} samples to WAV file in {self.save_directory}...")
                 stdout, stderr = proc.communicate()  # Wait for the command to complete
                 #print(stdout)
-            return self.get_last_capture_data()
+            return True
 
         except Exception as e:
             print(f"Error during data capture or processing: {e}")
+            return False
 
-    def get_last_capture_data(self):
+    def capture_to_store(self, store, samples, name=None, chunk_size=1 << 20, **metadata):
+        # Writes the capture into a capture_store.CaptureStore and returns its name there.
+        # The rpsa_client WAV is converted, with the experimental native receiver chunks go straight to disk.
+        if self.native:
+            writer = None
+            try:
+                for chunk in self.iter_chunks(samples, chunk_size):
+                    if writer is None:
+                        writer = store.writer(chunk.shape[1], self.samplerate, name=name, **metadata)
+                    writer.write(chunk)
+            except BaseException:
+                # An interrupted stream is not a short capture, keep it out of the store
+                if writer is not None:
+                    writer.abort()
+                raise
+            if writer is None:
+                return None
+            writer.close()
+            return writer.name
+        if self.capture_signal(samples) is None:
+            return None
+        return store.import_wav(self.last_capture_path, name=name, **metadata)
+
+    def capture_psd(self, samples=None, nperseg=1 << 16, channel=0, ewma=None, chunk_size=1 << 16, welch=None):
+        # Welch PSD (volts^2/Hz) of one channel computed while streaming, memory stays at one segment so
+        # hour long captures can go down to samplerate / nperseg. Pass `welch` to keep accumulating
+        # into an existing spectral.StreamingWelch, e.g. to look at the spectrum between calls.
+        for chunk in self.iter_chunks(samples, chunk_size, dtype="float32"):
+            if welch is None:
+                welch = spectral.StreamingWelch(self.samplerate, nperseg, ewma=ewma)
+            welch.update(chunk[:, channel])
+        return welch.psd()
+
+    def newest_capture(self):
         new_wav_files = glob.glob(os.path.join(self.save_directory, "*.wav"))
         if not new_wav_files:
             print("No file found after capture.")
-        new_wav_file = max(new_wav_files, key=os.path.getctime)  # Get the newest file
+        return max(new_wav_files, key=os.path.getctime)  # Get the newest file
+
+    def get_last_capture_data(self):
+        new_wav_file = self.newest_capture()
+        self.last_capture_path = new_wav_file
         #print(f"Reading data from {new_wav_file}...")
         self.last_capture_data, self.last_capture_samplerate = sf.read(new_wav_file)  # Reads float32 data
         return self.last_capture_data, self.last_capture_samplerate
@@ -0,0 +1,114 @@
+import statistics
+import numpy as np
+
+
+class SettlingDetector:
+    # Watches the variance of consecutive windows after a gain change. The transient is over once the
+    # last `stable_windows` window variances agree within `tolerance` (relative) and so do their means.
+    # (samples, channels) chunks are watched on `channel` only, the windows of two signals with
+    # different levels would never agree.
+    def __init__(self, tolerance=0.25, stable_windows=3, channel=0):
+        self.tolerance = tolerance
+        self.stable_windows = stable_windows
+        self.channel = channel
+        self.means = []
+        self.variances = []
+        self.samples = 0
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if chunk.ndim > 1:
+            chunk = chunk[:, self.channel]
+        self.means.append(chunk.mean())
+        self.variances.append(chunk.var())
+        self.samples += len(chunk)
+        return self.settled
+
+    @property
+    def settled(self):
+        if len(self.variances) < self.stable_windows:
+            return False
+        variances = self.variances[-self.stable_windows:]
+        means = self.means[-self.stable_windows:]
+        spread = np.sqrt(max(np.mean(variances), 1e-30))
+        variance_stable = max(variances) <= (1 + self.tolerance) * max(min(variances), 1e-30)
+        mean_stable = max(means) - min(means) <= self.tolerance * spread
+        return variance_stable and mean_stable
+
+
+class RunningEstimate:
+    # Welford mean/variance over per-chunk fitness values with a normal confidence interval
+    def __init__(self, confidence=0.95):
+        self.z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def half_width(self):
+        if self.count < 2:
+            return np.inf
+        return self.z * np.sqrt(self._m2 / (self.count - 1) / self.count)
+
+
+class SettledCapture:
+    def __init__(self, data, fitness, half_width, settle_samples, samples, chunks, reason):
+        self.data = data  # Samples used for the estimate (after settling)
+        self.fitness = fitness
+        self.half_width = half_width
+        self.settle_samples = settle_samples  # Samples discarded as transient
+        self.samples = samples  # Total samples read from the stream
+        self.chunks = chunks
+        self.reason = reason  # "converged", "rejected", or "limit"
+
+    def __repr__(self):
+        return (f"SettledCapture(fitness={self.fitness:.6g} +- {self.half_width:.3g}, reason={self.reason}, "
+                f"settle_samples={self.settle_samples}, samples={self.samples})")
+
+
+def settled_capture(chunks, chunk_fitness, confidence=0.95, relative_precision=0.05, min_chunks=4,
+                    max_samples=None, max_settle_samples=None, reject_below=None, detector=None, keep_data=True):
+    # chunks: iterator of sample blocks taken right after a gain change (e.g. RP_Streamer.iter_chunks or
+    # Acquirer buffers). chunk_fitness: block -> fitness of that block, higher is better. Blocks should be
+    # long compared to the loop's correlation time so the per-block values are roughly independent.
+    #
+    # Stops as soon as the fitness is known to `relative_precision` at `confidence`, when the whole
+    # interval is below `reject_below` (clearly worse than candidates we already have), or at max_samples.
+    detector = detector or SettlingDetector()
+    if max_settle_samples is None and max_samples is not None:
+        max_settle_samples = max_samples // 2  # A loop that never settles is scored on what is left
+    estimate = RunningEstimate(confidence)
+    settle_samples = None
+    samples = 0
+    kept = []
+    reason = "limit"
+    for chunk in chunks:
+        samples += len(chunk)
+        if settle_samples is None:
+            settled = detector.update(chunk)
+            if not settled and (max_settle_samples is None or samples < max_settle_samples):
+                continue
+            # The window that confirmed settling is already representative, use it
+            settle_samples = samples - len(chunk)
+        estimate.add(chunk_fitness(chunk))
+        if keep_data:
+            kept.append(np.array(chunk, copy=True))
+        if estimate.count >= min_chunks:
+            if estimate.half_width <= relative_precision * abs(estimate.mean):
+                reason = "converged"
+                break
+            if reject_below is not None and estimate.mean + estimate.half_width < reject_below:
+                reason = "rejected"
+                break
+        if max_samples is not None and samples >= max_samples:
+            break
+    data = np.concatenate(kept) if kept else np.zeros(0)
+    fitness = estimate.mean if estimate.count else -np.inf
+    return SettledCapture(data, fitness, estimate.half_width, samples if settle_samples is None else settle_samples, samples,
+                          estimate.count, reason)
@@ -6,31 +6,157 @@ import matplotlib
 matplotlib.use('TkAgg')  # Use the TkAgg backend for interactive plotting
 import os
 import fnmatch
+import glob
+import json
+import posixpath
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from csv_loader import load_csv
 
 
-def fetch_files_from_directory(host, username, password, remote_directory, files=[]):
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username=username, password=password)
-
-        with ssh.open_sftp() as sftp:
-            local_directory = os.path.basename(remote_directory) or "downloads"
-            os.makedirs(local_directory, exist_ok=True)
-
-            remote_files = sftp.listdir(remote_directory)
-            for pattern in files:
-                matching_files = fnmatch.filter(remote_files, pattern)
-                for file in matching_files:
-                    remote_file_path = os.path.join(remote_directory, file)
-                    local_file_path = os.path.join(local_directory, file)
-                    sftp.get(remote_file_path, local_file_path)
-                    print(f"File successfully copied: {remote_file_path} -> {local_file_path}")
+MANIFEST_FILENAME = ".sync_manifest.json"
+_ssh_clients = {}  # (host, port, username) -> connected paramiko.SSHClient, reused between syncs
+_ssh_clients_lock = threading.Lock()
+
+
+def get_ssh_client(host, username, password, port=22):
+    key = (host, port, username)
+    with _ssh_clients_lock:
+        ssh = _ssh_clients.get(key)
+        if ssh is None or ssh.get_transport() is None or not ssh.get_transport().is_active():
+            ssh = paramiko.SSHClient()
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh.connect(host, port=port, username=username, password=password)
+            _ssh_clients[key] = ssh
+        return ssh
+
+
+def close_ssh_clients():
+    with _ssh_clients_lock:
+        for ssh in _ssh_clients.values():
+            ssh.close()
+        _ssh_clients.clear()
+
+
+class SftpSync:
+    # Mirrors matching files of a remote directory into a local one over a pooled SSH connection.
+    # A manifest of the remote size and mtime of every downloaded file means unchanged files are not
+    # transferred again, downloads run over several SFTP channels at once and go to a .part file
+    # that is resumed if an earlier transfer was interrupted.
+    def __init__(self, host, username, password, port=22, channels=4, block_size=1 << 20):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.port = port
+        self.channels = channels
+        self.block_size = block_size
+        self._local = threading.local()
+        self._open_channels = []  # Every SFTP channel opened by any thread, closed by close()
+        self._channels_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def sftp(self):
+        # One SFTP channel per worker thread, all on the same SSH transport
+        transport = get_ssh_client(self.host, self.username, self.password, self.port).get_transport()
+        sftp = getattr(self._local, "sftp", None)
+        if sftp is None or getattr(self._local, "transport", None) is not transport:
+            sftp = paramiko.SFTPClient.from_transport(transport)
+            self._local.sftp, self._local.transport = sftp, transport
+            with self._channels_lock:
+                self._open_channels.append(sftp)
+        return sftp
+
+    def close(self):
+        # Closes the SFTP channels, the pooled SSH connection stays open for the next sync
+        with self._channels_lock:
+            channels, self._open_channels = self._open_channels, []
+        for sftp in channels:
+            sftp.close()
+        self._local = threading.local()
+
+    @staticmethod
+    def load_manifest(local_directory):
+        path = os.path.join(local_directory, MANIFEST_FILENAME)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
 
+    @staticmethod
+    def save_manifest(local_directory, manifest):
+        path = os.path.join(local_directory, MANIFEST_FILENAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(path + ".tmp", path)
+
+    def sync(self, remote_directory, patterns, local_directory):
+        # Returns the local paths of the files that were downloaded
+        os.makedirs(local_directory, exist_ok=True)
+        manifest = self.load_manifest(local_directory)
+        remote_files = {entry.filename: entry for entry in self.sftp().listdir_attr(remote_directory)
+                        if stat.S_ISREG(entry.st_mode)}
+        wanted = sorted({name for pattern in patterns for name in fnmatch.filter(remote_files, pattern)})
+        changed = []
+        for name in wanted:
+            entry = remote_files[name]
+            known = manifest.get(name)
+            local_path = os.path.join(local_directory, name)
+            if (known and known["size"] == entry.st_size and known["mtime"] == entry.st_mtime
+                    and os.path.exists(local_path) and os.path.getsize(local_path) == entry.st_size):
+                continue
+            changed.append(entry)
+        print(f"{len(wanted)} matching files, {len(changed)} new or changed")
+
+        downloaded = []
+        with ThreadPoolExecutor(max_workers=self.channels) as pool:
+            futures = [pool.submit(self.download, posixpath.join(remote_directory, entry.filename),
+                                   os.path.join(local_directory, entry.filename), entry.st_size, entry.st_mtime)
+                       for entry in changed]
+            for entry, future in zip(changed, futures):
+                downloaded.append(future.result())
+                manifest[entry.filename] = {"size": entry.st_size, "mtime": entry.st_mtime}
+                self.save_manifest(local_directory, manifest)  # Finished files survive a later failure
+        return downloaded
+
+    def download(self, remote_path, local_path, size, mtime):
+        # Only a partial download of this exact remote version is resumed
+        part_path = f"{local_path}.{size}-{int(mtime)}.part"
+        for stale in glob.glob(glob.escape(local_path) + ".*.part"):
+            if stale != part_path:
+                os.remove(stale)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        with self.sftp().open(remote_path, "rb") as remote, open(part_path, "r+b" if offset else "wb") as local:
+            remote.seek(offset)
+            local.seek(offset)
+            local.truncate()
+            remote.prefetch(size)
+            while True:
+                block = remote.read(self.block_size)
+                if not block:
+                    break
+                local.write(block)
+        os.replace(part_path, local_path)
+        if offset:
+            print(f"File successfully copied: {remote_path} -> {local_path} (resumed at {offset} bytes)")
+        else:
+            print(f"File successfully copied: {remote_path} -> {local_path}")
+        return local_path
+
+
+def fetch_files_from_directory(host, username, password, remote_directory, files=[], channels=4):
+    local_directory = os.path.basename(remote_directory) or "downloads"
+    try:
+        with SftpSync(host, username, password, channels=channels) as sync:
+            return sync.sync(remote_directory, files, local_directory)
     except Exception as e:
         print(f"Error fetching files: {e}")
-    finally:
-        ssh.close()
+        return []
 
 
 def plot_csv_data(signal, time_points, volts=True, fft=False):
@@ -66,42 +192,62 @@ def plot_csv_data(signal, time_points, volts=True, fft=False):
     plt.show()
 
 
-def analyze_locking_time(signal, time_points):
-    def in_range(val):
-        lock_value = 1756
-        lock_width = 5
-        return lock_value + lock_width > val > lock_value - lock_width
-
-    only_locked = [in_range(val) for val in signal]
-    filter_cutoff = 200
-    time_width = time_points[1]
-    in_sequence = False
-    sequence_lengths = []
-    seq_length = 0
-    for locked in only_locked:
-        if locked:
-            if not in_sequence:
-                in_sequence = True
-                seq_length = 1
-            else:
-                seq_length += 1
-        else:
-            if in_sequence:
-                in_sequence = False
-                if seq_length > filter_cutoff:
-                    sequence_lengths.append(seq_length)
-    print(f"Number of locked sequences = {len(sequence_lengths)}")
-    print(f"One sample is {time_width} long")
-    print(f"Locking Length cutoff is {time_width * filter_cutoff}")
-    print(f"Average Lock Time {np.mean(sequence_lengths) * time_width}")
-    plt.figure()
-    plt.plot(time_points, signal)
-    plt.figure()
-    plt.plot(only_locked)
-    plt.show()
-    return np.mean(sequence_lengths) * time_width
+def lock_runs(signal, lock_value=1756, lock_width=5, min_samples=200):
+    # (starts, stops) sample indices of the runs inside lock_value +- lock_width, stop exclusive. A run
+    # still going at the end of the signal counts, runs of min_samples or fewer samples are dropped.
+    signal = np.asarray(signal)
+    locked = (signal > lock_value - lock_width) & (signal < lock_value + lock_width)
+    edges = np.diff(np.concatenate([[0], locked.view(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+    keep = stops - starts > min_samples
+    return starts[keep], stops[keep], locked
+
+
+def lock_statistics(signal, time_points, lock_value=1756, lock_width=5, min_samples=200):
+    starts, stops, locked = lock_runs(signal, lock_value, lock_width, min_samples)
+    time_width = time_points[1] - time_points[0]
+    durations = (stops - starts) * time_width
+    total_time = len(signal) * time_width
+    if len(durations):
+        mean, median, p10, p90, longest = np.mean(durations), np.median(durations), *np.percentile(durations, [10, 90]), np.max(durations)
+    else:
+        mean = median = p10 = p90 = longest = np.nan
+    return {
+        "lock_count": len(durations),
+        "sample_time": time_width,
+        "min_lock_time": time_width * min_samples,
+        "mean_lock_time": mean,
+        "median_lock_time": median,
+        "p10_lock_time": p10,
+        "p90_lock_time": p90,
+        "longest_lock_time": longest,
+        "locked_time": np.sum(durations),
+        "locked_fraction": np.sum(durations) / total_time if total_time else np.nan,
+        "time_to_first_lock": starts[0] * time_width if len(starts) else None,
+        "locked_at_end": bool(len(stops) and stops[-1] == len(signal)),
+        "starts": starts,
+        "stops": stops,
+        "locked": locked,
+    }
+
 
-    pass
+def analyze_locking_time(signal, time_points, lock_value=1756, lock_width=5, min_samples=200, plot=True):
+    report = lock_statistics(signal, time_points, lock_value, lock_width, min_samples)
+    print(f"Number of locked sequences = {report['lock_count']}")
+    print(f"One sample is {report['sample_time']} long")
+    print(f"Locking Length cutoff is {report['min_lock_time']}")
+    print(f"Average Lock Time {report['mean_lock_time']}")
+    print(f"Median Lock Time {report['median_lock_time']} (10%: {report['p10_lock_time']}, "
+          f"90%: {report['p90_lock_time']}, longest: {report['longest_lock_time']})")
+    print(f"Locked {100 * report['locked_fraction']:.1f}% of the time, first lock after {report['time_to_first_lock']}")
+    if plot:
+        plt.figure()
+        plt.plot(time_points, signal)
+        plt.figure()
+        plt.plot(report["locked"])
+        plt.show()
+    return report
 
 
 # Main function
@@ -116,12 +262,12 @@ def main():
     )
 
     # Plot the data
-    data = np.loadtxt("downloads/acquisition_data.csv", delimiter=",")
+    data = load_csv("downloads/acquisition_data.csv")
     # Extract time points and signal values
     time_points = data[:, 0]
     signal = data[:, 1]
     plot_csv_data(signal, time_points, volts=False)
-    average_lock_time = analyze_locking_time(signal, time_points)
+    average_lock_time = analyze_locking_time(signal, time_points)["mean_lock_time"]
 
 
 if __name__ == "__main__":
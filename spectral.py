@@ -0,0 +1,163 @@
+import functools
+import numpy as np
+from scipy.signal import get_window
+
+# Spectra of real captures without plotting, shared by pid_analysis, noise_analysis and the optimizers'
+# fitness functions. Real-input FFTs only, frequency axes and windows are built once per size.
+WELCH_BATCH_FRAMES = 4096  # Frames transformed at once, bounds the temporary memory of welch()
+
+
+@functools.lru_cache(maxsize=64)
+def rfft_frequencies(n, samplerate):
+    frequencies = np.fft.rfftfreq(n, d=1 / samplerate)
+    frequencies.flags.writeable = False
+    return frequencies
+
+
+@functools.lru_cache(maxsize=64)
+def spectral_window(name, n):
+    # Same (periodic) windows scipy.signal.welch uses
+    window = get_window(name, n)
+    window.flags.writeable = False
+    return window
+
+
+def fft_power(x, samplerate):
+    # |FFT|^2 / N over the positive frequencies, the raw periodogram pid_analysis has always plotted
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    power = np.abs(np.fft.rfft(x)) ** 2 / n
+    return rfft_frequencies(n, samplerate)[:n // 2], power[:n // 2]
+
+
+def welch(x, samplerate, nperseg=1024, noverlap=None, window="hann"):
+    # Matches scipy.signal.welch defaults (constant detrend, one-sided density, mean of the frames),
+    # computed with batched rffts over strided views of the signal
+    x = np.asarray(x, dtype=np.float64)
+    nperseg = min(nperseg, len(x))
+    step = nperseg - (nperseg // 2 if noverlap is None else noverlap)
+    taper = spectral_window(window, nperseg)
+    frames = np.lib.stride_tricks.sliding_window_view(x, nperseg)[::step]
+    total = np.zeros(nperseg // 2 + 1)
+    for start in range(0, len(frames), WELCH_BATCH_FRAMES):
+        batch = frames[start:start + WELCH_BATCH_FRAMES]
+        batch = (batch - batch.mean(axis=1, keepdims=True)) * taper
+        total += np.sum(np.abs(np.fft.rfft(batch, axis=1)) ** 2, axis=0)
+    return rfft_frequencies(nperseg, samplerate), one_sided_density(total / len(frames), samplerate, taper)
+
+
+def one_sided_density(power, samplerate, taper):
+    # Mean |rfft|^2 of windowed frames -> one-sided PSD in units^2/Hz
+    psd = power / (samplerate * np.sum(taper ** 2))
+    nperseg = len(taper)
+    if nperseg % 2:
+        psd[1:] *= 2
+    else:
+        psd[1:-1] *= 2
+    return psd
+
+
+def log_bin(frequencies, power, bins_per_decade=20):
+    # Averages a spectrum into logarithmically spaced bins for plotting, empty bins and DC are dropped
+    frequencies = np.asarray(frequencies)
+    power = np.asarray(power)
+    positive = frequencies > 0
+    frequencies, power = frequencies[positive], power[positive]
+    if len(frequencies) == 0:
+        return frequencies, power
+    decades = np.log10(frequencies[-1]) - np.log10(frequencies[0])
+    edges = np.logspace(np.log10(frequencies[0]), np.log10(frequencies[-1]),
+                        max(2, int(np.ceil(decades * bins_per_decade)) + 1))
+    index = np.clip(np.searchsorted(edges, frequencies, side="right") - 1, 0, len(edges) - 2)
+    counts = np.bincount(index, minlength=len(edges) - 1)
+    used = counts > 0
+    mean_frequency = np.bincount(index, weights=frequencies, minlength=len(edges) - 1)[used] / counts[used]
+    mean_power = np.bincount(index, weights=power, minlength=len(edges) - 1)[used] / counts[used]
+    return mean_frequency, mean_power
+
+
+def psd_ratio(stable, unstable, normalize=True):
+    # Stabilized over unstabilized spectrum, each normalized to its mean as in the original plots
+    stable = np.asarray(stable, dtype=np.float64)
+    unstable = np.asarray(unstable, dtype=np.float64)
+    if normalize:
+        stable = stable / np.mean(stable)
+        unstable = unstable / np.mean(unstable)
+    return stable / unstable
+
+
+def band_power(frequencies, psd, band):
+    # Integral of a PSD over [low, high) in units^2
+    frequencies = np.asarray(frequencies)
+    mask = (frequencies >= band[0]) & (frequencies < band[1])
+    df = frequencies[1] - frequencies[0] if len(frequencies) > 1 else 1.0
+    return float(np.sum(np.asarray(psd)[mask]) * df)
+
+
+def suppression_db(frequencies, stable, unstable, bands):
+    # Noise suppression in dB for each (low, high) band, positive when the loop reduces the noise
+    return np.array([10 * np.log10(band_power(frequencies, unstable, band) / band_power(frequencies, stable, band))
+                     for band in bands])
+
+
+class StreamingWelch:
+    # Welch PSD of a signal that arrives in blocks of any size. Only the samples of the next
+    # unfinished frame are kept between blocks, so memory stays at one segment however long the
+    # capture runs. With ewma=None every frame counts equally and the result equals welch() on the
+    # concatenated blocks, with ewma=alpha each new frame gets weight alpha and old ones fade out.
+    def __init__(self, samplerate, nperseg=1024, noverlap=None, window="hann", ewma=None):
+        self.samplerate = samplerate
+        self.nperseg = nperseg
+        self.step = nperseg - (nperseg // 2 if noverlap is None else noverlap)
+        self.taper = spectral_window(window, nperseg)
+        self.ewma = ewma
+        self.pending = np.zeros(0)  # Samples from the start of the next frame on
+        self.total = np.zeros(nperseg // 2 + 1)
+        self.frames = 0
+
+    def update(self, block):
+        # block: 1-D samples of one channel, e.g. chunk[:, channel] of a (samples, channels) chunk
+        block = np.asarray(block, dtype=np.float64)
+        if block.ndim != 1:
+            raise ValueError(f"StreamingWelch takes one channel of 1-D samples, got shape {block.shape}")
+        x = np.concatenate([self.pending, block])
+        if len(x) < self.nperseg:
+            self.pending = x
+            return 0
+        frames = np.lib.stride_tricks.sliding_window_view(x, self.nperseg)[::self.step]
+        for start in range(0, len(frames), WELCH_BATCH_FRAMES):
+            batch = frames[start:start + WELCH_BATCH_FRAMES]
+            batch = (batch - batch.mean(axis=1, keepdims=True)) * self.taper
+            power = np.abs(np.fft.rfft(batch, axis=1)) ** 2
+            if self.ewma is None:
+                self.total += power.sum(axis=0)
+            else:
+                # The same as applying total = (1 - a) * total + a * frame for each frame in order
+                decay = (1 - self.ewma) ** np.arange(len(power) - 1, -1, -1)
+                if self.frames == 0 and start == 0:
+                    decay[0] /= self.ewma  # The first frame seeds the average
+                self.total = (1 - self.ewma) ** len(power) * self.total + self.ewma * (decay @ power)
+            self.frames += len(batch)
+        self.pending = x[len(frames) * self.step:]
+        return len(frames)
+
+    def run(self, blocks):
+        for block in blocks:
+            self.update(block)
+        return self.psd()
+
+    @property
+    def frequencies(self):
+        return rfft_frequencies(self.nperseg, self.samplerate)
+
+    def psd(self):
+        # (frequencies, psd) of everything so far, can be called at any time
+        if self.frames == 0:
+            return self.frequencies, np.full(len(self.total), np.nan)
+        power = self.total / self.frames if self.ewma is None else self.total
+        return self.frequencies, one_sided_density(power, self.samplerate, self.taper)
+
+    def reset(self):
+        self.pending = np.zeros(0)
+        self.total[:] = 0
+        self.frames = 0
@@ -0,0 +1,271 @@
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+# Every packet is a fixed header followed by one payload per channel:
+#   magic, packet index, samples lost since the previous packet, sample rate (Hz),
+#   resolution (bits per sample), channel count, channel 1 payload bytes, channel 2 payload bytes.
+# All parsing of the wire format lives in read_packet/pack_packet.
+#
+# NOTE: this framing is our own and has only been run against FakeStreamingServer below. It has not
+# been checked against the Red Pitaya streaming server's protocol, so for a real board rpsa_client
+# (RP_Streamer's default) is still the way to capture. Until read_packet is verified against the
+# firmware, StreamReceiver only connects with allow_unverified=True, which FakeStreamingServer users
+# pass and which RP_Streamer(experimental_native=True) and lock_monitor --experimental-native set to
+# try a board on purpose. Nothing else depends on it.
+PROTOCOL_VERIFIED = False
+PACKET_MAGIC = b"RPSA"
+PACKET_HEADER = struct.Struct("<4sQQIHHII")
+SAMPLE_DTYPES = {8: np.dtype("<i1"), 16: np.dtype("<i2")}
+
+
+class StreamProtocolError(Exception):
+    pass
+
+
+class RingBuffer:
+    # Preallocated FIFO of (samples, channels) frames. Writes that would overflow drop the oldest data.
+    def __init__(self, capacity, channels=2, dtype=np.int16):
+        self.data = np.zeros((capacity, channels), dtype=dtype)
+        self.capacity = capacity
+        self.channels = channels
+        self.start = 0
+        self.size = 0
+        self.overflowed = 0
+
+    @property
+    def free(self):
+        return self.capacity - self.size
+
+    def _make_room(self, n):
+        if n > self.free:
+            dropped = n - self.free
+            self.overflowed += dropped
+            self.start = (self.start + dropped) % self.capacity
+            self.size -= dropped
+        return (self.start + self.size) % self.capacity
+
+    def write(self, block):
+        # block has shape (n, channels)
+        self.write_channels([block[:, channel] for channel in range(self.channels)])
+
+    def write_channels(self, channel_samples):
+        # One equal-length 1-D array per channel, copied straight into the ring columns
+        n = len(channel_samples[0])
+        if n > self.capacity:
+            self.overflowed += n - self.capacity
+            channel_samples = [samples[-self.capacity:] for samples in channel_samples]
+            n = self.capacity
+        end = self._make_room(n)
+        first = min(n, self.capacity - end)
+        for channel, samples in enumerate(channel_samples):
+            self.data[end:end + first, channel] = samples[:first]
+            self.data[:n - first, channel] = samples[first:n]
+        self.size += n
+
+    def read(self, n, out=None):
+        n = min(n, self.size)
+        if out is None:
+            out = np.empty((n, self.channels), dtype=self.data.dtype)
+        first = min(n, self.capacity - self.start)
+        out[:first] = self.data[self.start:self.start + first]
+        out[first:n] = self.data[:n - first]
+        self.start = (self.start + n) % self.capacity
+        self.size -= n
+        return out[:n]
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+
+class StreamReceiver:
+    def __init__(self, host, port=8900, ring_capacity=1 << 20, timeout=5.0, allow_unverified=False):
+        self.host = host
+        self.port = port
+        self.allow_unverified = allow_unverified  # Connect although the protocol is only known to match the fake server
+        self.ring_capacity = ring_capacity
+        self.timeout = timeout
+        self.sock = None
+        self.ring = None
+        self.samplerate = None
+        self.resolution = None
+        self.channels = None
+        self.lost_samples = 0
+        self.last_packet_index = None
+        self._scratch = bytearray(1 << 16)
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def connect(self):
+        if not PROTOCOL_VERIFIED and not self.allow_unverified:
+            raise StreamProtocolError("The native stream format has only been tested against FakeStreamingServer, not "
+                                      "the Red Pitaya streaming server. Capture through rpsa_client instead, or pass "
+                                      "allow_unverified=True to try it anyway.")
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.lost_samples = 0
+        self.last_packet_index = None
+        if self.ring is not None:
+            self.ring.clear()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _recv_exact(self, n):
+        if len(self._scratch) < n:
+            self._scratch = bytearray(n)
+        view = memoryview(self._scratch)[:n]
+        received = 0
+        while received < n:
+            count = self.sock.recv_into(view[received:], n - received)
+            if count == 0:
+                raise ConnectionError("Streaming server closed the connection")
+            received += count
+        return view
+
+    def read_packet(self):
+        header = PACKET_HEADER.unpack(self._recv_exact(PACKET_HEADER.size))
+        magic, index, lost, samplerate, resolution, channels, size1, size2 = header
+        if magic != PACKET_MAGIC:
+            raise StreamProtocolError(f"Bad packet magic {bytes(magic)!r}, is this a FakeStreamingServer?")
+        if resolution not in SAMPLE_DTYPES:
+            raise StreamProtocolError(f"Unsupported resolution {resolution} bits")
+        payload = self._recv_exact(size1 + size2)
+        dtype = SAMPLE_DTYPES[resolution]
+        # Views into the scratch buffer, only valid until the next read
+        samples = [np.frombuffer(payload[:size1], dtype=dtype)]
+        if channels > 1:
+            samples.append(np.frombuffer(payload[size1:size1 + size2], dtype=dtype))
+        self.lost_samples += lost
+        self.last_packet_index = index
+        self.samplerate = samplerate
+        self.resolution = resolution
+        self.channels = channels
+        return samples
+
+    def _fill_ring(self):
+        samples = self.read_packet()
+        if self.ring is None or self.ring.channels != self.channels:
+            self.ring = RingBuffer(self.ring_capacity, self.channels)
+        frames = min(len(channel) for channel in samples)
+        self.ring.write_channels([values[:frames] for values in samples])
+        return frames
+
+    def scale(self):
+        # Full scale of the integer samples, soundfile uses the same for WAV captures
+        return float(1 << (self.resolution - 1))
+
+    def iter_chunks(self, samples=None, chunk_size=65536, dtype=np.int16):
+        # Yields (chunk_size, channels) blocks as the packets arrive, the last one may be shorter.
+        # Packets are only read when the consumer asks for the next block, so a slow consumer
+        # makes TCP push back on the server instead of growing memory. samples=None streams forever.
+        dtype = np.dtype(dtype)
+        if dtype not in (np.dtype(np.int16), np.dtype(np.float32)):
+            raise ValueError("Chunks are int16 raw samples or float32 scaled to +-1")
+        remaining = samples
+        while remaining is None or remaining > 0:
+            n = chunk_size if remaining is None else min(chunk_size, remaining)
+            while self.ring is None or self.ring.size < n:
+                self._fill_ring()
+                if self.ring.capacity < n:
+                    raise ValueError(f"chunk_size {n} is larger than the ring buffer ({self.ring.capacity})")
+            chunk = self.ring.read(n)
+            if dtype == np.float32:
+                chunk = chunk.astype(np.float32) / np.float32(self.scale())
+            if remaining is not None:
+                remaining -= n
+            yield chunk
+
+    def receive(self, samples):
+        # Raw int16 frames, shape (samples, channels)
+        out = None
+        filled = 0
+        while filled < samples:
+            self._fill_ring()
+            if out is None:
+                out = np.empty((samples, self.channels), dtype=np.int16)
+            filled += len(self.ring.read(samples - filled, out=out[filled:]))
+        return out, self.samplerate
+
+
+def pack_packet(index, channel_samples, samplerate, lost=0, resolution=16):
+    dtype = SAMPLE_DTYPES[resolution]
+    payloads = [np.asarray(samples, dtype=dtype).tobytes() for samples in channel_samples]
+    sizes = [len(payload) for payload in payloads] + [0]
+    header = PACKET_HEADER.pack(PACKET_MAGIC, index, lost, int(samplerate), resolution, len(payloads),
+                                sizes[0], sizes[1])
+    return header + b"".join(payloads)
+
+
+class FakeStreamingServer:
+    # Local stand-in for the board's streaming server. Sends a generated two channel signal,
+    # by default a slow ramp on channel 2 and a noisy sine on channel 1.
+    def __init__(self, host="127.0.0.1", port=0, samplerate=125e6 / 1024, packet_samples=8192,
+                 signal=None, realtime=False):
+        self.samplerate = samplerate
+        self.packet_samples = packet_samples
+        self.signal = signal or self.default_signal
+        self.realtime = realtime
+        self.server = socket.create_server((host, port))
+        self.host, self.port = self.server.getsockname()[:2]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def receiver(self, **kwargs):
+        return StreamReceiver(self.host, self.port, allow_unverified=True, **kwargs)
+
+    def default_signal(self, start, n):
+        t = (start + np.arange(n)) / self.samplerate
+        rng = np.random.default_rng(start)
+        ch1 = 8000 * np.sin(2 * np.pi * 50 * t) + rng.normal(0, 200, n)
+        ch2 = 16000 * (2 * np.abs((t * 10) % 1 - 0.5) - 0.5)
+        return ch1, ch2
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self.server.close()
+        self._thread.join(timeout=1)
+
+    def _serve(self):
+        while self._running:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._stream, args=(connection,), daemon=True).start()
+
+    def _stream(self, connection):
+        start = 0
+        index = 0
+        with connection:
+            while self._running:
+                channels = self.signal(start, self.packet_samples)
+                try:
+                    connection.sendall(pack_packet(index, channels, self.samplerate))
+                except OSError:
+                    return
+                start += self.packet_samples
+                index += 1
+                if self.realtime:
+                    time.sleep(self.packet_samples / self.samplerate)
@@ -0,0 +1,187 @@
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize
+from scipy.special import ndtr
+
+# Gaussian-process surrogate optimizer for the PID gains, an alternative to the genetic algorithms when
+# every evaluation is a hardware capture. After a space-filling start, each candidate is the point with
+# the highest expected improvement under a GP fitted to all fitness values so far, so far fewer captures
+# are spent on gains that are clearly worse. ask() proposes gains, tell() reports their fitness (higher
+# is better), candidates of one batch are spread out by treating earlier ones as already measured.
+SQRT5 = np.sqrt(5)
+
+
+def matern52(a, b, lengthscales, variance):
+    scaled_a, scaled_b = a / lengthscales, b / lengthscales
+    sq = (np.sum(scaled_a ** 2, axis=1)[:, None] + np.sum(scaled_b ** 2, axis=1)[None, :]
+          - 2 * scaled_a @ scaled_b.T)
+    r = np.sqrt(np.maximum(sq, 0))
+    return variance * (1 + SQRT5 * r + 5 / 3 * r ** 2) * np.exp(-SQRT5 * r)
+
+
+class GaussianProcess:
+    # Matern 5/2 kernel with one lengthscale per dimension, hyperparameters by maximum likelihood.
+    # Inputs are expected in the unit cube, targets are standardized internally.
+    LOG_BOUNDS = [(np.log(1e-2), np.log(1e1)), (np.log(1e-2), np.log(1e2)), (np.log(1e-6), np.log(1.0))]
+
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+        # log lengthscales, log signal variance, log noise variance
+        self.theta = np.concatenate([np.full(dimensions, np.log(0.3)), [0.0, np.log(1e-2)]])
+
+    def unpack(self, theta):
+        return np.exp(theta[:self.dimensions]), np.exp(theta[-2]), np.exp(theta[-1])
+
+    def negative_log_likelihood(self, theta, x, y):
+        lengthscales, variance, noise = self.unpack(theta)
+        k = matern52(x, x, lengthscales, variance) + (noise + 1e-9) * np.eye(len(x))
+        try:
+            factor = cho_factor(k, lower=True)
+        except np.linalg.LinAlgError:
+            return 1e10
+        alpha = cho_solve(factor, y)
+        return 0.5 * y @ alpha + np.sum(np.log(np.diag(factor[0]))) + 0.5 * len(x) * np.log(2 * np.pi)
+
+    def fit(self, x, y, optimize=True, restarts=2, rng=None):
+        self.x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.y_mean = y.mean()
+        self.y_std = y.std() if y.std() > 0 else 1.0
+        self.y = (y - self.y_mean) / self.y_std
+        if optimize and len(self.x) > 1:
+            bounds = [self.LOG_BOUNDS[0]] * self.dimensions + self.LOG_BOUNDS[1:]
+            rng = np.random.default_rng() if rng is None else rng
+            starts = [self.theta] + [rng.uniform(*np.array(bounds).T) for _ in range(restarts)]
+            best = None
+            for start in starts:
+                result = minimize(self.negative_log_likelihood, start, args=(self.x, self.y), method="L-BFGS-B",
+                                  bounds=bounds)
+                if best is None or result.fun < best.fun:
+                    best = result
+            self.theta = best.x
+        lengthscales, variance, noise = self.unpack(self.theta)
+        k = matern52(self.x, self.x, lengthscales, variance) + (noise + 1e-9) * np.eye(len(self.x))
+        self.factor = cho_factor(k, lower=True)
+        self.alpha = cho_solve(self.factor, self.y)
+        return self
+
+    def predict(self, x):
+        # (mean, standard deviation) in the original units of y
+        lengthscales, variance, noise = self.unpack(self.theta)
+        k_star = matern52(np.asarray(x, dtype=np.float64), self.x, lengthscales, variance)
+        mean = k_star @ self.alpha
+        v = cho_solve(self.factor, k_star.T)
+        var = np.maximum(variance - np.sum(k_star * v.T, axis=1), 1e-12)
+        return self.y_mean + self.y_std * mean, self.y_std * np.sqrt(var)
+
+
+def expected_improvement(mean, std, best, xi=0.01):
+    # For maximization, xi (in units of the fitness spread) trades exploration against exploitation
+    improvement = mean - best - xi
+    z = improvement / std
+    return improvement * ndtr(z) + std * np.exp(-0.5 * z ** 2) / np.sqrt(2 * np.pi)
+
+
+class SurrogateOptimizer:
+    # bounds: (genes, 2) array of [low, high], genes with low == high stay fixed. initial_points are
+    # evaluated first (e.g. known good gains), then n_initial points from a Latin hypercube in total.
+    def __init__(self, bounds, initial_points=None, n_initial=None, integer=False, xi=0.01, candidates=4096,
+                 seed=None):
+        self.bounds = np.asarray(bounds, dtype=np.float64)
+        self.low = self.bounds[:, 0]
+        self.width = self.bounds[:, 1] - self.bounds[:, 0]
+        self.free = self.width > 0
+        self.integer = integer
+        self.xi = xi
+        self.candidates = candidates
+        self.rng = np.random.default_rng(seed)
+        self.gp = GaussianProcess(int(np.count_nonzero(self.free)))
+        self.x = []  # Evaluated points in the original units
+        self.y = []
+
+        initial = [] if initial_points is None else [np.clip(p, self.bounds[:, 0], self.bounds[:, 1])
+                                                     for p in np.asarray(initial_points, dtype=np.float64)]
+        n_initial = max(2 * np.count_nonzero(self.free) + 1, len(initial)) if n_initial is None else n_initial
+        self.initial = initial + list(self.from_unit(self.latin_hypercube(max(n_initial - len(initial), 0))))
+        self.n_initial = len(self.initial)
+
+    def latin_hypercube(self, n):
+        dims = np.count_nonzero(self.free)
+        cells = np.array([self.rng.permutation(n) for _ in range(dims)]).T
+        return (cells + self.rng.random((n, dims))) / max(n, 1)
+
+    def to_unit(self, x):
+        return (np.asarray(x, dtype=np.float64)[..., self.free] - self.low[self.free]) / self.width[self.free]
+
+    def from_unit(self, u):
+        x = np.tile(self.low, (len(u), 1))
+        x[:, self.free] += np.asarray(u) * self.width[self.free]
+        return np.round(x) if self.integer else x
+
+    def training_data(self):
+        # Failed evaluations (-inf, nan) count as a bit worse than the worst real one
+        y = np.array(self.y, dtype=np.float64)
+        finite = np.isfinite(y)
+        if not finite.any():
+            return None, None
+        worst = y[finite].min() - (y[finite].std() if finite.sum() > 1 else 1.0)
+        return self.to_unit(np.array(self.x)), np.where(finite, y, worst)
+
+    def ask(self, n=1):
+        # (n, genes) array of gains to evaluate next
+        proposals = []
+        while self.initial and len(proposals) < n:
+            proposals.append(self.initial.pop(0))
+        if len(proposals) == n:
+            return np.array(proposals)
+        x, y = self.training_data()
+        if x is None or len(x) < 2:
+            proposals += list(self.from_unit(self.rng.random((n - len(proposals), np.count_nonzero(self.free)))))
+            return np.array(proposals)
+
+        self.gp.fit(x, y, rng=self.rng)
+        best_y = y.max()
+        fantasy_x, fantasy_y = list(x), list(y)
+        for _ in range(n - len(proposals)):
+            candidates = self.candidate_points(np.array(fantasy_x), np.array(fantasy_y))
+            mean, std = self.gp.predict(candidates)
+            choice = candidates[np.argmax(expected_improvement(mean, std, best_y, self.xi * self.gp.y_std))]
+            proposals.append(self.from_unit(choice[None])[0])
+            # Pretend the GP mean was measured there so the next candidate of the batch goes elsewhere
+            fantasy_x.append(self.to_unit(proposals[-1]))
+            fantasy_y.append(float(self.gp.predict(fantasy_x[-1][None])[0][0]))
+            self.gp.fit(np.array(fantasy_x), np.array(fantasy_y), optimize=False)
+        return np.array(proposals)
+
+    def candidate_points(self, x, y):
+        # Uniform samples plus perturbations of the best points so far, in the unit cube
+        dims = x.shape[1]
+        uniform = self.rng.random((self.candidates, dims))
+        top = x[np.argsort(y)[::-1][:5]]
+        local = top[self.rng.integers(len(top), size=self.candidates // 2)]
+        local = local + self.rng.normal(scale=0.05, size=local.shape) * self.rng.choice([0.2, 1.0, 3.0], size=(len(local), 1))
+        return np.clip(np.vstack([uniform, local]), 0, 1)
+
+    def tell(self, points, values):
+        for point, value in zip(np.atleast_2d(points), np.atleast_1d(values)):
+            self.x.append(np.asarray(point, dtype=np.float64))
+            self.y.append(float(value))
+
+    @property
+    def best(self):
+        # (gains, fitness) of the best evaluation so far
+        y = np.array(self.y, dtype=np.float64)
+        index = int(np.argmax(np.where(np.isfinite(y), y, -np.inf)))
+        return self.x[index], self.y[index]
+
+    def run(self, evaluate_batch, evaluations, batch_size=1, on_batch=None):
+        # evaluate_batch: (batch, genes) array -> fitness values. Returns (gains, fitness) of the best.
+        batch_index = 0
+        while len(self.y) < evaluations:
+            points = self.ask(min(batch_size, evaluations - len(self.y)))
+            values = evaluate_batch(points)
+            self.tell(points, values)
+            if on_batch is not None:
+                on_batch(batch_index, points, values)
+            batch_index += 1
+        return self.best